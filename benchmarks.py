@@ -0,0 +1,116 @@
+""" Micro-benchmarks for the hot paths of gdriveapi
+
+Run with:
+
+    python benchmarks.py [item count]
+"""
+import json
+import sys
+import time
+
+from collections import namedtuple
+
+import gdriveapi
+
+# A file resource with the keys Google Drive v2 returns for a typical file
+SAMPLE_FILE = dict((key, "value") for key in (
+    'kind', 'id', 'etag', 'selfLink', 'webContentLink', 'alternateLink',
+    'embedLink', 'iconLink', 'thumbnailLink', 'title', 'mimeType',
+    'labels', 'createdDate', 'modifiedDate', 'modifiedByMeDate',
+    'lastViewedByMeDate', 'markedViewedByMeDate', 'version', 'parents',
+    'downloadUrl', 'userPermission', 'originalFilename', 'fileExtension',
+    'md5Checksum', 'fileSize', 'quotaBytesUsed', 'ownerNames', 'owners',
+    'lastModifyingUserName', 'lastModifyingUser', 'editable', 'copyable',
+    'writersCanShare', 'shared', 'explicitlyTrashed', 'appDataContents',
+    'headRevisionId', 'spaces'))
+
+
+def namedtuple_per_file(files):
+    """ create_gdrive_files as it was, building a new type for every file """
+    file_list = []
+    for f in files:
+        GDriveFile = namedtuple('GDriveFile', f.keys())
+        file_list.append(GDriveFile(**f))
+    return file_list
+
+
+def cached_type_per_key_set(files):
+    """ create_gdrive_files as it is now """
+    file_list = []
+    for f in files:
+        GDriveFile = gdriveapi.gdrive_file_type(f.keys())
+        file_list.append(GDriveFile(**f))
+    return file_list
+
+
+def type_size(cls):
+    """ Approximate size of a class object, its namespace and methods """
+    size = sys.getsizeof(cls) + sys.getsizeof(cls.__dict__)
+    for value in cls.__dict__.values():
+        size += sys.getsizeof(value)
+    return size
+
+
+def measure_memory(records):
+    """ Measures the memory used per record, including the memory used by
+    the GDriveFile types the records were built with """
+    types = dict((id(type(record)), type(record)) for record in records)
+    size = sum(sys.getsizeof(record) for record in records)
+    size += sum(type_size(cls) for cls in types.values())
+    return size / float(len(records))
+
+
+def bench_create_gdrive_files(count=100000):
+    print("create_gdrive_files, %d items" % count)
+    files = [dict(SAMPLE_FILE, id=str(x)) for x in xrange(count)]
+    for create_files in (namedtuple_per_file, cached_type_per_key_set):
+        start = time.time()
+        records = create_files(files)
+        seconds = time.time() - start
+        print("  %-24s %8.2f us/item %8.0f bytes/item" % (
+            create_files.__name__, seconds / count * 1e6,
+            measure_memory(records)))
+
+
+def bench_fields(count=100000):
+    print("files().list page parsing, %d items" % count)
+    gdrive = gdriveapi.GDriveAPI.__new__(gdriveapi.GDriveAPI)
+    full = dict(SAMPLE_FILE, labels={'trashed': False}, 
+        parents=[{'id': 'folder', 'kind': 'drive#parentReference',
+            'selfLink': 'value', 'parentLink': 'value', 'isRoot': False}])
+    minimal = dict((key, full[key]) for key in gdriveapi.MINIMAL_FIELDS)
+    for name, item in (('full resources', full), 
+            ('MINIMAL_FIELDS', minimal)):
+        body = json.dumps({'items': [dict(item, id=str(x)) 
+            for x in xrange(count)]})
+        start = time.time()
+        records = gdrive.create_gdrive_files(json.loads(body)['items'])
+        seconds = time.time() - start
+        print("  %-24s %8.0f bytes/item %8.2f us/item %8.0f bytes/record" % (
+            name, len(body) / float(count), seconds / count * 1e6,
+            measure_memory(records)))
+
+
+def bench_parse(count=10000):
+    print("GDriveAPIParser.parse, %d queries" % count)
+    parser = gdriveapi.GDriveAPIParser()
+    queries = [
+        {'title_contains': 'report %d' % x, 'parents_in': 'folder%d' % x}
+        for x in xrange(count)]
+    def parse_with_grammars(**kwargs):
+        return [token for query, val in kwargs.items()
+            for token in parser.parse_with_grammars(query, val)]
+    for parse in (parse_with_grammars, parser.parse):
+        start = time.time()
+        for query in queries:
+            parse(**query)
+        seconds = time.time() - start
+        print("  %-24s %8.2f us/query" % (parse.__name__, 
+            seconds / count * 1e6))
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    bench_create_gdrive_files(count)
+    bench_fields(count)
+    bench_parse()
@@ -1,28 +1,517 @@
-import httplib2
+import BaseHTTPServer
+import errno
 import json
 import dataset
 import logging
+import multiprocessing
+import os
+import Queue
+import re
+import shutil
+import socket
+import threading
+import time
+import uuid
 
-from apiclient.discovery import build
 from apiclient.http import MediaFileUpload
 from oauth2client.client import OAuth2WebServerFlow
 from oauth2client.file import Storage
 from apiclient import errors
+from gdriveapi import FOLDER_MIME_TYPE, GDriveAPI, file_md5, safe_filename
+from gdriveapi import InMemoryMetrics, RequestExecutor
+from multiprocessing.pool import ThreadPool
+
+# The file resource fields folder listings request, those used by the
+# metadata index and backup_file
+WALK_FIELDS = ('id', 'title', 'mimeType', 'modifiedDate', 'md5Checksum', 
+    'fileSize', 'labels(trashed)', 'parents(id)', 'downloadUrl', 
+    'exportLinks')
+# A job of the JobQueue is given up on after failing this many times
+JOB_MAX_ATTEMPTS = 5
+# Lifetime asked for notification channels, Google Drive may give less
+CHANNEL_TTL_SECONDS = 24 * 60 * 60
+# Notification channels are replaced this long before they expire
+CHANNEL_RENEW_SECONDS = 10 * 60
+
+
+class MetadataIndex:
+    """ A local mirror of Google Drive file metadata kept in the backup
+    database, which answers GDriveAPI style queries without any requests
+    to Google Drive """
+
+    def __init__(self, db, api):
+        self.db = db
+        self.api = api
+        self.files = db.get_table('file_table', primary_id='file_id', 
+                primary_type=db.types.string(128))
+        for column in ('title', 'mimeType', 'modifiedDate', 'md5Checksum'):
+            self.files.create_column(column, db.types.text)
+        self.files.create_column('fileSize', db.types.bigint)
+        self.files.create_column('trashed', db.types.boolean)
+        self.files.create_index(['modifiedDate'])
+        self.files.create_index(['title'])
+        self.parents = db['parent_table']
+        self.parents.create_column('file_id', db.types.string(128))
+        self.parents.create_column('parent_id', db.types.string(128))
+        self.parents.create_index(['parent_id'])
+        self.parents.create_index(['file_id'])
+
+    def add_files(self, files):
+        """ Adds or updates the metadata of GDriveFiles in the index """
+        with self.db as tx:
+            files_table = tx['file_table']
+            parents_table = tx['parent_table']
+            for gdrive_file in files:
+                file_size = getattr(gdrive_file, 'fileSize', None)
+                labels = getattr(gdrive_file, 'labels', None) or {}
+                files_table.upsert({
+                    "file_id": gdrive_file.id,
+                    "title": gdrive_file.title,
+                    "mimeType": gdrive_file.mimeType,
+                    "modifiedDate": getattr(gdrive_file, 'modifiedDate', None),
+                    "md5Checksum": getattr(gdrive_file, 'md5Checksum', None),
+                    "fileSize": int(file_size) if file_size else None,
+                    "trashed": bool(labels.get('trashed')),
+                }, ['file_id'])
+                parents_table.delete(file_id=gdrive_file.id)
+                parents_table.insert_many([{
+                    "file_id": gdrive_file.id,
+                    "parent_id": parent['id']
+                } for parent in getattr(gdrive_file, 'parents', None) or []])
+
+    def remove_file(self, file_id):
+        """ Removes a file from the index """
+        with self.db as tx:
+            tx['file_table'].delete(file_id=file_id)
+            tx['parent_table'].delete(file_id=file_id)
+
+    def query(self, **kwargs):
+        """ Answers a query from the index, accepts the same keyword
+        arguments as GDriveAPI.get_file_info for the title, mimeType,
+        modifiedDate, trashed and parents fields.
+
+        Returns:
+            A list of GDriveFile objects (namedtuples)
+        """
+        conditions = []
+        params = {}
+        for x, token in enumerate(self.api.parser.parse(**kwargs)):
+            param = "p%d" % x
+            value = token.value
+            if isinstance(value, list):
+                if token.field != 'parents':
+                    raise ValueError("Field " + token.field + " can't be "
+                        "given several values in the local index")
+                # Any of the parents, bound one parameter per parent
+                names = ["%s_%d" % (param, y) for y in range(len(value))]
+                conditions.append("EXISTS (SELECT 1 FROM parent_table p "
+                    "WHERE p.file_id = f.file_id AND p.parent_id IN (%s))"
+                    % ", ".join(":" + name for name in names))
+                params.update(zip(names, value))
+                continue
+            if not isinstance(value, (bool, basestring)):
+                value = " ".join(value)
+            if token.field == 'parents':
+                conditions.append("EXISTS (SELECT 1 FROM parent_table p "
+                    "WHERE p.file_id = f.file_id AND p.parent_id = :%s)" 
+                    % param)
+            elif token.field == 'title' and token.operator == 'contains':
+                conditions.append("f.title LIKE :%s ESCAPE '\\'" % param)
+                # Match %, _ and \ in titles literally
+                value = "%" + re.sub(r'([%_\\])', r'\\\1', value) + "%"
+            elif token.field == 'modifiedDate':
+                conditions.append("f.modifiedDate %s :%s" % (
+                    token.operator, param))
+                value = drive_timestamp(value)
+            elif token.field == 'trashed':
+                conditions.append("f.trashed = :%s" % param)
+                if not isinstance(value, bool):
+                    value = value.lower() == 'true'
+            elif token.field in ('title', 'mimeType'):
+                conditions.append("f.%s = :%s" % (token.field, param))
+            else:
+                raise ValueError("Field " + token.field 
+                    + " is not available in the local index")
+            params[param] = value
+        sql = "SELECT * FROM file_table f"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        files = []
+        for row in self.db.query(sql, **params):
+            row = dict(row)
+            row['id'] = row.pop('file_id')
+            row['parents'] = [{'id': parent['parent_id']} for parent in
+                self.parents.find(file_id=row['id'])]
+            files.append(row)
+        return self.api.create_gdrive_files(files)
+
+
+class PathResolver:
+    """ Resolves slash separated Google Drive paths, such as "a/b/c", to 
+    folder ids using an index of folder titles kept in the backup database.
+    Paths are resolved together one level at a time, listing the sub folders
+    of every folder needed for that level in one batch, and folders are only
+    ever listed once. """
+
+    def __init__(self, db, api):
+        self.db = db
+        self.api = api
+        self.folders = db['folder_index_table']
+        self.folders.create_column('folder_id', db.types.string(128))
+        self.folders.create_column('parent_id', db.types.string(128))
+        self.folders.create_column('title', db.types.text)
+        self.folders.create_index(['parent_id', 'title'])
+        self.folders.create_index(['folder_id'])
+        # Folders whose sub folders are all in the folder_index_table
+        self.listed = db.get_table('listed_folder_table', 
+                primary_id='folder_id', primary_type=db.types.string(128))
+
+    def root_id(self):
+        """ Returns the id of the root folder of the drive """
+        sync_table = self.db['sync_table']
+        state = sync_table.find_one(name='rootFolderId')
+        if state:
+            return state['value']
+        about = self.api.execute(self.api.drive_service.about().get(
+                fields='rootFolderId'))
+        self.set_root_id(about['rootFolderId'])
+        return about['rootFolderId']
+
+    def set_root_id(self, root_id):
+        """ Remembers the id of the root folder of the drive """
+        self.db['sync_table'].upsert({
+            "name": "rootFolderId",
+            "value": root_id
+        }, ['name'])
+
+    def resolve(self, paths):
+        """ Resolves many paths at once
+
+        Args:
+            paths: Slash separated paths relative to the root of the drive
+
+        Returns:
+            A tuple of two dictionaries keyed by path, the first holds the
+            folder id of every resolved path and the second holds the 
+            exception raised by every path that could not be resolved
+        """
+        root_id = self.root_id()
+        # Every unresolved path, with the folder its resolved part leads to
+        pending = dict((path, (root_id, [part for part in path.split('/') 
+            if part])) for path in paths)
+        folder_ids = {}
+        failures = {}
+        listing_failures = {}
+        while pending:
+            self.list_folders(set(parent_id for parent_id, parts 
+                in pending.values() if parts), listing_failures)
+            for path, (parent_id, parts) in pending.items():
+                if not parts:
+                    folder_ids[path] = parent_id
+                    del pending[path]
+                    continue
+                if parent_id in listing_failures:
+                    failures[path] = listing_failures[parent_id]
+                    del pending[path]
+                    continue
+                matches = [row['folder_id'] for row in self.folders.find(
+                    parent_id=parent_id, title=parts[0])]
+                if len(matches) != 1:
+                    # Missing, or ambiguous because of duplicate titles
+                    failures[path] = KeyError("%d folders named %s in %s" % (
+                        len(matches), parts[0], parent_id))
+                    del pending[path]
+                    continue
+                pending[path] = (matches[0], parts[1:])
+        return folder_ids, failures
+
+    def list_folders(self, folder_ids, failures):
+        """ Adds the sub folders of every folder which hasn't been listed
+        before to the index, listing them in one batch. Folders that could 
+        not be listed are added to failures. """
+        queries = {}
+        for folder_id in folder_ids:
+            if not self.listed.find_one(folder_id=folder_id):
+                queries[folder_id] = self.api.construct_list_query(
+                    parents_in=folder_id, mimeType=FOLDER_MIME_TYPE,
+                    trashed=False, maxResults=1000, 
+                    fields=['id', 'title', 'parents(id)'])
+        if not queries:
+            return
+        responses, errors = self.api.execute_batch(dict(
+            (folder_id, self.api.drive_service.files().list(**query))
+            for folder_id, query in queries.items()))
+        for folder_id, error in errors.items():
+            logging.warning("HTTP Error: " + str(error))
+            failures[folder_id] = error
+        for folder_id, response in responses.items():
+            folders = self.api.create_gdrive_files(response.get('items', []))
+            if response.get('nextPageToken'):
+                # Fetch the remaining pages one at a time
+                folders += list(self.api.iter_query(dict(queries[folder_id],
+                    pageToken=response['nextPageToken'])))
+            with self.db as tx:
+                tx['folder_index_table'].delete(parent_id=folder_id)
+                tx['folder_index_table'].insert_many([{
+                    "folder_id": folder.id,
+                    "parent_id": folder_id,
+                    "title": folder.title
+                } for folder in folders])
+                tx['listed_folder_table'].upsert({"folder_id": folder_id}, 
+                    ['folder_id'])
+
+    def update(self, gdrive_folder):
+        """ Updates the index for a folder reported by the changes feed """
+        self.remove(gdrive_folder.id, forget_children=False)
+        if gdrive_folder.labels['trashed']:
+            return
+        self.folders.insert_many([{
+            "folder_id": gdrive_folder.id,
+            "parent_id": parent['id'],
+            "title": gdrive_folder.title
+        } for parent in getattr(gdrive_folder, 'parents', [])
+            if self.listed.find_one(folder_id=parent['id'])])
+
+    def remove(self, folder_id, forget_children=True):
+        """ Removes a folder from the index """
+        self.folders.delete(folder_id=folder_id)
+        if forget_children:
+            self.folders.delete(parent_id=folder_id)
+            self.listed.delete(folder_id=folder_id)
+
+
+class JobQueue:
+    """ The work of backing up folders, kept in the backup database so that
+    an interrupted run continues where it stopped and several worker
+    processes can share a run. Every job belongs to a root, the id of the
+    folder being backed up, and is either a folder to list or a file to
+    back up into a directory. A job is pending until a worker claims it,
+    running until the worker finishes it, then done, or pending again if it
+    failed and failed once it has failed max_attempts times.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.jobs = db.get_table('job_table')
+        for column in ('root', 'kind', 'item_id', 'state', 'owner', 'claim'):
+            self.jobs.create_column(column, db.types.string(128))
+        for column in ('key', 'directory', 'payload', 'error'):
+            self.jobs.create_column(column, db.types.text)
+        self.jobs.create_column('attempts', db.types.integer)
+        # A folder is listed once per root, even when it is in several
+        # folders, a file is backed up once into each directory it is in
+        db.query("CREATE UNIQUE INDEX IF NOT EXISTS job_table_key ON "
+            "job_table (root, kind, key)")
+        self.jobs.create_index(['state', 'kind'])
+        self.jobs.create_index(['claim'])
+        self.max_attempts = JOB_MAX_ATTEMPTS
+        # Identifies the jobs claimed by this process
+        self.owner = "%s:%d" % (socket.gethostname(), os.getpid())
+
+    def add(self, root, jobs):
+        """ Queues jobs, leaving out jobs which have been queued before
+
+        Args:
+            root: Id of the folder the jobs are part of
+            jobs: A list of dictionaries of the kind ("folder" or "file"),
+                  item_id and directory of each job, and for files the
+                  payload, the file resource as JSON
+        """
+        with self.db as tx:
+            for job in jobs:
+                key = job['item_id']
+                if job['kind'] == 'file':
+                    key += '/' + job['directory']
+                tx.query("INSERT OR IGNORE INTO job_table (root, kind, key, "
+                    "item_id, directory, payload, state, attempts) VALUES "
+                    "(:root, :kind, :key, :item_id, :directory, :payload, "
+                    "'pending', 0)", root=root, kind=job['kind'], key=key,
+                    item_id=job['item_id'], directory=job['directory'],
+                    payload=job.get('payload'))
+
+    def claim(self, kind, limit=1):
+        """ Claims up to limit pending jobs of a kind for this process. A
+        single UPDATE claims the jobs, so no two workers claim the same job.
+
+        Returns:
+            A list of job dictionaries
+        """
+        claim = uuid.uuid4().hex
+        self.db.query("UPDATE job_table SET state = 'running', owner = "
+            ":owner, claim = :claim, attempts = attempts + 1 WHERE id IN "
+            "(SELECT id FROM job_table WHERE state = 'pending' AND kind = "
+            ":kind ORDER BY id LIMIT :limit)", owner=self.owner,
+            claim=claim, kind=kind, limit=limit)
+        return list(self.jobs.find(claim=claim, order_by='id'))
+
+    def complete(self, job):
+        """ Marks a claimed job as done """
+        self.jobs.update({"id": job['id'], "state": "done", "error": None},
+            ['id'])
+
+    def fail(self, job, error):
+        """ Returns a claimed job to the queue to be tried again, or marks
+        it as failed once it has been attempted max_attempts times """
+        state = 'failed' if job['attempts'] >= self.max_attempts else \
+            'pending'
+        self.jobs.update({"id": job['id'], "state": state,
+            "error": str(error)}, ['id'])
+
+    def requeue_abandoned(self):
+        """ Returns the running jobs of processes on this host which have
+        exited, such as a run which crashed or was killed, to the queue """
+        host = socket.gethostname()
+        for row in self.db.query("SELECT DISTINCT owner FROM job_table "
+                "WHERE state = 'running'"):
+            owner_host, _, pid = row['owner'].rpartition(':')
+            if owner_host != host or process_exists(int(pid)):
+                continue
+            logging.info("Requeueing the jobs of exited worker %s",
+                row['owner'])
+            self.db.query("UPDATE job_table SET state = 'pending' WHERE "
+                "state = 'running' AND owner = :owner", owner=row['owner'])
+
+    def retry(self, root):
+        """ Gives the failed jobs of a root another max_attempts attempts
+        """
+        self.db.query("UPDATE job_table SET state = 'pending', attempts = 0"
+            " WHERE root = :root AND state = 'failed'", root=root)
+
+    def count(self, root=None, state=None):
+        """ Counts the jobs of a root, or of every root, in a state, or in
+        any state """
+        filters = {}
+        if root is not None:
+            filters['root'] = root
+        if state is not None:
+            filters['state'] = state
+        return self.jobs.count(**filters)
+
+    def failures(self, root):
+        """ Returns the failed jobs of a root """
+        return list(self.jobs.find(root=root, state='failed'))
+
+    def folders(self, root):
+        """ Returns a dictionary of the ids of the folders queued beneath a
+        root to their directories """
+        return dict((job['item_id'], job['directory']) for job in
+            self.jobs.find(root=root, kind='folder')
+            if job['item_id'] != root)
+
+    def clear(self, root):
+        """ Removes every job of a root """
+        self.jobs.delete(root=root)
+
+
+def process_exists(pid):
+    """ Returns whether a process with the given pid is running """
+    try:
+        os.kill(pid, 0)
+    except OSError, error:
+        # EPERM means the process exists but belongs to someone else
+        return error.errno == errno.EPERM
+    return True
+
+
+def contained_path(root, relative):
+    """ Joins a slash separated relative path onto root, raising a 
+    ValueError if the result would be outside of root """
+    path = os.path.normpath(os.path.join(root, *relative.split('/')))
+    root = os.path.normpath(root)
+    if path != root and not path.startswith(os.path.join(root, '')):
+        raise ValueError("%r is outside of %r" % (relative, root))
+    return path
+
+def drive_timestamp(value):
+    """ Converts an ISO 8601 timestamp into the fixed width format Google
+    Drive uses (2013-10-01T12:00:00.000Z), so timestamps compare correctly
+    as strings """
+    millis = value[20:23] if value[19:20] == '.' else '000'
+    return value[:19] + '.' + millis + 'Z'
+
+
+class NotificationServer(BaseHTTPServer.HTTPServer):
+    """ A small HTTP endpoint which receives Google Drive push notifications
+    and queues them as dictionaries of the channel_id, token, state and 
+    message_number of each notification. Google Drive only sends 
+    notifications to https addresses, put the server behind an https proxy
+    whose address is given to GDriveBackup.watch. """
+
+    def __init__(self, address=('', 8080)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, 
+            NotificationHandler)
+        self.notifications = Queue.Queue()
+        self.thread = None
+
+    def start(self):
+        """ Serves notifications on a background thread """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stops serving and closes the listening socket """
+        if self.thread is not None:
+            self.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server_close()
+
+
+class NotificationHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Queues the notifications posted to a NotificationServer """
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            # Change notifications have no body, the changes are listed
+            # from the changes feed
+            self.rfile.read(length)
+        self.server.notifications.put({
+            "channel_id": self.headers.get('X-Goog-Channel-ID'),
+            "token": self.headers.get('X-Goog-Channel-Token'),
+            "state": self.headers.get('X-Goog-Resource-State'),
+            "message_number": self.headers.get('X-Goog-Message-Number'),
+        })
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logging.debug("Notification server: " + format, *args)
 
-logging.basicConfig(filename='gdrive_backup.log', level=logging.DEBUG)
 
 class GDriveBackup:
     
-    def __init__(self, config_path="config.json"):
+    def __init__(self, config_path="config.json", metrics=None, 
+            interactive=True):
+        """
+        Args:
+            config_path: The account's config, which besides the paths to
+                         back up may give its own credentials_file, 
+                         database URL and quota, the RequestExecutor 
+                         arguments limiting its requests
+            metrics: An optional metrics sink, see gdriveapi.InMemoryMetrics
+            interactive: Whether missing credentials are asked for on the
+                         console, otherwise a ValueError is raised
+        """
+        with open(config_path) as config_file:
+            account = json.load(config_file)
         # Determine if credentials exist
-        self.credentials_file  = Storage("gdrive_credentials")
+        credentials_path = account.get('credentials_file', 
+                'gdrive_credentials')
+        self.credentials_file  = Storage(credentials_path)
         self.credentials = self.credentials_file.get()
         # Init connection to SQLite database
-        self.db = dataset.connect('sqlite:///gdrive_backup.db')
+        self.db = dataset.connect(account.get('database', 
+                'sqlite:///gdrive_backup.db'))
         # Assume the config path is in the current dir
         self.config_path = config_path
         # Parse the config file for client secret and id
         self.parse_config()
+        if not self.credentials and not interactive:
+            raise ValueError("No credentials in " + credentials_path + ", "
+                "run gdrive-backup.py --config " + config_path + " once to "
+                "authenticate")
         if not self.credentials:
             logging.debug("Parsing config and authenticating..")
             # No credentials exist, user must authenticate and get creds 
@@ -36,10 +525,24 @@ class GDriveBackup:
         else:
             # Use previously stored credentials
             self.credentials = self.credentials_file.get()
-                # Build the drive service
-        http = httplib2.Http()
-        http = self.credentials.authorize(http)
-        self.drive_service = build('drive', 'v2', http=http)
+        # Build the drive service from the stored credentials
+        self.api = GDriveAPI(credentials_path, metrics=metrics, 
+            executor=RequestExecutor(**account.get('quota', {})))
+        # Optional metrics sink, see gdriveapi.InMemoryMetrics
+        self.metrics = metrics
+        self.drive_service = self.api.drive_service
+        self.index = MetadataIndex(self.db, self.api)
+        self.resolver = PathResolver(self.db, self.api)
+        self.jobs = JobQueue(self.db)
+        # The local path of every backed up file and the state of the file
+        # when it was last downloaded
+        local_path_table = self.db.get_table('local_path_table')
+        local_path_table.create_column('path', self.db.types.text)
+        local_path_table.create_column('file_id', self.db.types.string(128))
+        for column in ('md5Checksum', 'modifiedDate'):
+            local_path_table.create_column(column, self.db.types.text)
+        local_path_table.create_column('fileSize', self.db.types.bigint)
+        local_path_table.create_index(['path'])
 
     def parse_config(self):
         # Parsing config occurs only on the first occurence
@@ -48,6 +551,9 @@ class GDriveBackup:
             self.CLIENT_SECRET = json_config['client_secret']
             self.CLIENT_ID     = json_config['client_id']
             self.paths         = json_config['paths']
+            # Content addressed store holding one copy of every file
+            self.store_path    = json_config.get('store_path', 
+                    'gdrive_store')
             # Persist path data so we dont have to continually parse config
             for path in self.paths:
                 # Add paths to path_table
@@ -71,56 +577,553 @@ class GDriveBackup:
             self.credentials_file.put(self.credentials)
     
     def get_folder_id(self, folder):
-        # Construct the correct dictionary to find the folder
-        query_dict = self.construct_query_dict(folder)
-        # make a request for this folder
-        gdrive_folder = self.drive_service.files().list(
-                **query_dict).execute()
-        logging.debug(gdrive_folder)
-        if len(gdrive_folder['items']) > 0:
-            # Return id of the first item
-            return gdrive_folder['items'][0]['id']
-        else:
-            raise KeyError("Response returned empty")
+        # Resolve the folder's path through the folder index
+        folder_ids, failures = self.resolver.resolve([folder['gdrive_path']])
+        if failures:
+            raise failures.values()[0]
+        return folder_ids[folder['gdrive_path']]
+
+    def resolve_folder_ids(self):
+        """ Looks up the folder id of every configured path which doesn't 
+        have one yet, resolving them all together with the PathResolver,
+        and stores the ids in the path_table
+        """
+        path_table = self.db['path_table']
+        rows = dict((folder['gdrive_path'], folder) 
+            for folder in path_table.all() if not folder.get('folder_id'))
+        if not rows:
+            return []
+        folder_ids, failures = self.resolver.resolve(rows.keys())
+        for gdrive_path, folder_id in folder_ids.items():
+            logging.debug("Updating row with id: %s", 
+                    rows[gdrive_path]['id'])
+            path_table.update({
+                "id": rows[gdrive_path]['id'],
+                "folder_id": folder_id
+            }, ['id'])
+        failed = []
+        for gdrive_path, error in failures.items():
+            logging.warning("Could not resolve %s: %s", gdrive_path, error)
+            if isinstance(error, errors.HttpError):
+                failed.append(error)
+        return failed
+
+    def get_list(self, new_only=False):
+        """ Backs up everything beneath every configured path. The work is
+        queued in the job_table (see JobQueue), so a run which is
+        interrupted continues where it stopped, and other processes can
+        help with it by running run_jobs.
 
-    def get_list(self):
+        Args:
+            new_only: Only back up the paths which haven't been backed up
+                      in full before, such as paths added to the config
+                      since the last run
+        """
+        # Resolve every missing folder id in as few requests as possible
+        failures = self.resolve_folder_ids()
         path_table = self.db['path_table']
-        paths = path_table.all()
-        for folder in paths:
-            # If no ID was set for the folder, get a folder id
-            if not folder.get('folder_id'):
+        folders = []
+        for folder in list(path_table.all()):
+            folder_id = folder.get('folder_id')
+            if not folder_id:
+                # The folder could not be found
+                continue
+            if new_only and folder.get('crawled'):
+                continue
+            # Jobs left by an interrupted run are kept, the failed ones
+            # are tried again
+            self.jobs.retry(folder_id)
+            self.jobs.add(folder_id, [{"kind": "folder",
+                "item_id": folder_id,
+                "directory": folder['filesystem_path']}])
+            folders.append(folder)
+        self.run_jobs()
+        for folder in folders:
+            jobs_failed = self.jobs.failures(folder['folder_id'])
+            if jobs_failed:
+                # Carry on with the other folders and report the failure
+                # after
+                failures.append(IOError("%d jobs backing up %s failed, "
+                    "the first with: %s" % (len(jobs_failed),
+                    folder['gdrive_path'], jobs_failed[0]['error'])))
+                continue
+            path_table.update({"id": folder['id'], "crawled": True}, ['id'])
+            self.jobs.clear(folder['folder_id'])
+        if failures:
+            # Fail the run so the backup is not recorded as complete
+            raise failures[0]
+
+    def backup_folder(self, folder_id, root):
+        """ Backs up everything beneath a folder id into the local directory
+        root, and remembers its sub folders so that changes to their
+        contents are backed up by sync
+
+        Returns:
+            A dictionary of the sub folder ids to their local directories
+
+        Raises:
+            IOError: Backing up some of the folder failed
+        """
+        self.jobs.retry(folder_id)
+        self.jobs.add(folder_id, [{"kind": "folder", "item_id": folder_id,
+            "directory": root}])
+        self.run_jobs()
+        jobs_failed = self.jobs.failures(folder_id)
+        if jobs_failed:
+            raise IOError("%d jobs backing up %s failed, the first with: %s"
+                % (len(jobs_failed), folder_id, jobs_failed[0]['error']))
+        folders = self.jobs.folders(folder_id)
+        self.jobs.clear(folder_id)
+        return folders
+
+    def run_jobs(self, max_concurrency=4):
+        """ Works through the job queue until no job is left. Folders are
+        listed first, up to max_concurrency at the same time, then files
+        are backed up one at a time. A failed job is tried again later, see
+        JobQueue. While other workers have jobs running, which may queue
+        more jobs, this waits for them.
+
+        Running this in other processes, for example with
+        gdrive-backup.py --worker, shares a run between them.
+        """
+        self.jobs.requeue_abandoned()
+        pool = ThreadPool(max_concurrency)
+        try:
+            while True:
+                jobs = self.jobs.claim('folder', max_concurrency)
+                if jobs:
+                    # Only the listing happens on the pool, the database is
+                    # used from this thread
+                    for job, (children, error) in zip(jobs, pool.map(
+                            self.list_folder, jobs)):
+                        if error is None:
+                            self.queue_children(job, children)
+                        else:
+                            logging.warning("Listing folder %s failed: %s",
+                                job['item_id'], error)
+                            self.jobs.fail(job, error)
+                    continue
+                jobs = self.jobs.claim('file', max_concurrency)
+                for job in jobs:
+                    gdrive_file = self.api.create_gdrive_files(
+                        [json.loads(job['payload'])])[0]
+                    try:
+                        self.backup_file(gdrive_file, job['directory'])
+                    except Exception, error:
+                        logging.warning("Backing up file %s failed: %s",
+                            job['item_id'], error)
+                        self.jobs.fail(job, error)
+                    else:
+                        self.jobs.complete(job)
+                if jobs:
+                    continue
+                if not self.jobs.count(state='running'):
+                    break
+                time.sleep(1)
+        finally:
+            pool.close()
+            pool.join()
+
+    def list_folder(self, job):
+        """ Lists the folder of a folder job, leaving out trashed files
+
+        Returns:
+            A tuple of the list of GDriveFiles, or None, and the error
+            listing the folder raised, or None
+        """
+        try:
+            return list(self.api.iter_files(parents_in=job['item_id'],
+                trashed=False, fields=WALK_FIELDS)), None
+        except Exception, error:
+            return None, error
+
+    def queue_children(self, job, children):
+        """ Indexes the children of a listed folder, queues a job for each
+        of them, and remembers the sub folders so that changes to their
+        contents are backed up by sync """
+        self.index.add_files(children)
+        folder_table = self.db['folder_table']
+        jobs = []
+        for child in children:
+            if child.mimeType == FOLDER_MIME_TYPE:
+                directory = contained_path(job['directory'],
+                    safe_filename(child.title))
+                folder_table.upsert({
+                    "folder_id": child.id,
+                    "filesystem_path": directory
+                }, ['folder_id'])
+                jobs.append({"kind": "folder", "item_id": child.id,
+                    "directory": directory})
+            else:
+                jobs.append({"kind": "file", "item_id": child.id,
+                    "directory": job['directory'],
+                    "payload": json.dumps(child._asdict())})
+        self.jobs.add(job['root'], jobs)
+        self.jobs.complete(job)
+
+    def sync(self):
+        """ Backs up everything that changed since the last run using the
+        Google Drive changes feed. The first run performs a full backup with
+        get_list and records the largestChangeId to start from next time.
+        """
+        if self.metrics is not None:
+            with self.metrics.timer('backup_sync_seconds'):
+                return self.sync_changes()
+        return self.sync_changes()
+
+    def sync_changes(self):
+        """ Performs sync, see sync """
+        sync_table = self.db['sync_table']
+        state = sync_table.find_one(name='largestChangeId')
+        if not state:
+            # Record the starting point before crawling so that changes made
+            # during the crawl are picked up by the next run. A crawl which
+            # was interrupted keeps its starting point when it continues.
+            start = sync_table.find_one(name='crawlChangeId')
+            if start:
+                largest_change_id = start['value']
+            else:
+                about = self.api.execute(self.drive_service.about().get())
+                largest_change_id = about['largestChangeId']
+                if about.get('rootFolderId'):
+                    self.resolver.set_root_id(about['rootFolderId'])
+                sync_table.upsert({
+                    "name": "crawlChangeId",
+                    "value": str(largest_change_id)
+                }, ['name'])
+            self.get_list()
+            sync_table.delete(name='crawlChangeId')
+        else:
+            # Paths added to the config since the last run have no changes
+            # to start from, back them up in full
+            self.get_list(new_only=True)
+            largest_change_id = self.backup_changes(int(state['value']) + 1)
+        sync_table.upsert({
+            "name": "largestChangeId",
+            "value": str(largest_change_id)
+        }, ['name'])
+
+    def watch(self, address, server=None, stop=None, 
+            renew_seconds=CHANNEL_RENEW_SECONDS):
+        """ Keeps the backup up to date as Google Drive sends notifications
+        of changes, rather than listing everything on every run. A channel 
+        subscribing address to the changes feed is opened, and replaced 
+        before it expires, and every change notification runs sync, which
+        backs up the files changed since the last sync. Notifications which
+        arrive while a sync runs are handled by one more sync. No requests
+        are made while nothing changes, apart from renewing the channel.
+
+        Args:
+            address: The https URL Google Drive sends notifications to, 
+                     which must reach server
+            server: The NotificationServer receiving notifications, by 
+                    default one listening on port 8080
+            stop: A threading.Event which ends watching once set, otherwise
+                  watching continues until interrupted
+            renew_seconds: How long before it expires a channel is replaced
+        """
+        server = server or NotificationServer()
+        stop = stop or threading.Event()
+        token = uuid.uuid4().hex
+        sync_table = self.db['sync_table']
+        stale = sync_table.find_one(name='channel')
+        if stale:
+            # Left open by a watch which didn't stop cleanly
+            self.close_channel(json.loads(stale['value']))
+        server.start()
+        channel = None
+        try:
+            channel = self.open_channel(address, token)
+            self.sync()
+            while not stop.is_set():
+                renew_at = channel['expiration'] - renew_seconds
+                if time.time() >= renew_at:
+                    # Open the new channel before closing the old one so 
+                    # that no change goes unnoticed
+                    previous = channel
+                    channel = self.open_channel(address, token)
+                    self.close_channel(previous)
+                    continue
                 try:
-                    # Get the folder id
-                    folder_id = self.get_folder_id(folder)
-                    # update the current row with the new folder id
-                    # logging.debug("Updating row with id: " + str(folder['id']))
-                    # path_table.update({
-                    #     "id": folder['id'], 
-                    #     "folder_id": folder_id
-                    # }, ['id'])
-                except KeyError:
-                    # Response came back empty, so pass
-                    logging.warning("File Not Found: " + folder['gdrive_path'])
-                    pass
+                    notification = server.notifications.get(
+                        timeout=max(0, min(renew_at - time.time(), 1)))
+                except Queue.Empty:
+                    continue
+                notifications = [notification]
+                while True:
+                    try:
+                        notifications.append(
+                            server.notifications.get_nowait())
+                    except Queue.Empty:
+                        break
+                changed = False
+                for notification in notifications:
+                    if notification['token'] != token:
+                        logging.warning("Ignoring notification for channel"
+                            " %s with the wrong token", 
+                            notification['channel_id'])
+                    elif notification['state'] != 'sync':
+                        # The sync notification only confirms a new channel
+                        changed = True
+                if not changed:
+                    continue
+                try:
+                    self.sync()
                 except errors.HttpError, error:
-                    # Most likely an invalid request
-                    logging.warning("HTTP Error: " + error)
-                    pass
-            else:
-                folder_id = folder['folder_id']
-            # Get all children with this folder id
+                    # The changes are backed up by the next sync
+                    logging.warning("HTTP Error: " + str(error))
+        finally:
+            server.stop()
+            if channel is not None:
+                self.close_channel(channel)
+
+    def open_channel(self, address, token):
+        """ Subscribes address to notifications of changes to any file, and
+        records the channel so that it can be closed should watch not stop
+        cleanly
+
+        Returns:
+            A dictionary of the channel id, resourceId and the expiration in
+            seconds since the epoch
+        """
+        body = {
+            "id": str(uuid.uuid4()),
+            "type": "web_hook",
+            "address": address,
+            "token": token,
+            "expiration": int((time.time() + CHANNEL_TTL_SECONDS) * 1000),
+        }
+        response = self.api.execute(
+            self.drive_service.changes().watch(body=body))
+        channel = {
+            "id": body['id'],
+            "resourceId": response['resourceId'],
+            "expiration": int(response.get('expiration') or 
+                body['expiration']) / 1000.0,
+        }
+        logging.info("Opened notification channel %s", channel['id'])
+        self.db['sync_table'].upsert({
+            "name": "channel",
+            "value": json.dumps(channel)
+        }, ['name'])
+        return channel
+
+    def close_channel(self, channel):
+        """ Stops the notifications of a channel opened by open_channel """
+        try:
+            self.api.execute(self.drive_service.channels().stop(body={
+                "id": channel['id'],
+                "resourceId": channel['resourceId'],
+            }))
+            logging.info("Closed notification channel %s", channel['id'])
+        except errors.HttpError, error:
+            # The channel has expired already
+            logging.warning("Closing notification channel %s failed: %s",
+                channel['id'], error)
+        sync_table = self.db['sync_table']
+        state = sync_table.find_one(name='channel')
+        if state and json.loads(state['value'])['id'] == channel['id']:
+            sync_table.delete(name='channel')
+
+    def backup_changes(self, start_change_id):
+        """ Backs up the files in configured folders which changed since
+        start_change_id. Folders created in, moved into or renamed within a 
+        configured folder are backed up in full.
+
+        Returns:
+            The largestChangeId reported by Google Drive
+        """
+        folders = self.get_tracked_folders()
+        query = {"startChangeId": start_change_id, "includeDeleted": True}
+        while True:
+            response = self.api.execute(
+                    self.drive_service.changes().list(**query))
+            for change in response.get('items', []):
+                gdrive_file = change.get('file')
+                if change.get('deleted') or not gdrive_file:
+                    self.index.remove_file(change['fileId'])
+                    self.resolver.remove(change['fileId'])
+                    self.untrack_folder(change['fileId'], folders)
+                    continue
+                gdrive_file = self.api.create_gdrive_files([gdrive_file])[0]
+                self.index.add_files([gdrive_file])
+                if gdrive_file.mimeType == FOLDER_MIME_TYPE:
+                    self.resolver.update(gdrive_file)
+                    self.track_folder(gdrive_file, folders)
+                    continue
+                if gdrive_file.labels['trashed']:
+                    continue
+                for parent in getattr(gdrive_file, 'parents', []):
+                    if parent['id'] in folders:
+                        self.backup_file(gdrive_file, folders[parent['id']])
+            if not response.get('nextPageToken'):
+                return response['largestChangeId']
+            query['pageToken'] = response['nextPageToken']
+
+    def track_folder(self, gdrive_folder, folders):
+        """ Updates the folder_table and the folders dictionary (see 
+        get_tracked_folders) for a changed folder. A folder which is now
+        backed up to a different directory, because it is new, was moved or
+        was renamed, is backed up in full.
+        """
+        directory = None
+        if not gdrive_folder.labels['trashed']:
+            for parent in getattr(gdrive_folder, 'parents', []):
+                if parent['id'] in folders:
+                    directory = contained_path(folders[parent['id']],
+                        safe_filename(gdrive_folder.title))
+                    break
+        if self.db['path_table'].find_one(folder_id=gdrive_folder.id):
+            # Configured folders are always backed up to their own path
+            return
+        if directory is None:
+            # Trashed, or moved out of every configured folder
+            self.untrack_folder(gdrive_folder.id, folders)
+        elif folders.get(gdrive_folder.id) != directory:
+            folders[gdrive_folder.id] = directory
+            self.db['folder_table'].upsert({
+                "folder_id": gdrive_folder.id,
+                "filesystem_path": directory
+            }, ['folder_id'])
+            folders.update(self.backup_folder(gdrive_folder.id, directory))
+
+    def untrack_folder(self, folder_id, folders):
+        """ Stops backing up changes to a folder's contents """
+        if folder_id in folders and \
+                self.db['folder_table'].find_one(folder_id=folder_id):
+            self.db['folder_table'].delete(folder_id=folder_id)
+            del folders[folder_id]
+
+    def get_tracked_folders(self):
+        """ Returns a dictionary of the folder ids being backed up to the
+        local directory each is backed up to """
+        folders = {}
+        for folder in self.db['folder_table'].all():
+            folders[folder['folder_id']] = folder['filesystem_path']
+        for folder in self.db['path_table'].all():
+            if folder.get('folder_id'):
+                folders[folder['folder_id']] = folder['filesystem_path']
+        return folders
+
+    def backup_file(self, gdrive_file, directory):
+        """ Downloads a file into the given local directory, unless it is
+        unchanged since it was last downloaded there. A file whose title is
+        already used by another file in the same directory is saved with 
+        its id appended to the title. Google Docs are exported, and are 
+        exported again only once their modifiedDate changes.
+        
+        Files with an md5Checksum are kept in the content addressed store 
+        (see store_file) and hard linked into the directory, so a file with
+        the same contents as one already backed up is not downloaded again.
+        """
+        if gdrive_file.mimeType == FOLDER_MIME_TYPE:
+            return
+        resource = gdrive_file._asdict()
+        if not resource.get('downloadUrl') and not resource.get('exportLinks'):
+            logging.warning("Skipping file without content: " 
+                    + gdrive_file.title)
+            return
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = self.local_path(gdrive_file, directory, 
+            self.api.export_filename(resource))
+        local_path_table = self.db['local_path_table']
+        state = {
+            "path": path,
+            "md5Checksum": getattr(gdrive_file, 'md5Checksum', None),
+            "modifiedDate": getattr(gdrive_file, 'modifiedDate', None),
+            "fileSize": getattr(gdrive_file, 'fileSize', None),
+        }
+        if state['fileSize'] is not None:
+            state['fileSize'] = int(state['fileSize'])
+        previous = local_path_table.find_one(path=path)
+        if os.path.exists(path) and (state['md5Checksum'] or 
+                state['modifiedDate']) and all(previous.get(key) == value
+                    for key, value in state.items()):
+            logging.debug("Skipping unchanged file %s", gdrive_file.id)
+            self.count_file('unchanged')
+            return
+        if state['md5Checksum']:
+            blob = self.store_file(gdrive_file)
+            # Link the stored copy in next to the previous copy, then
+            # replace the previous copy in one step
+            if os.path.exists(path + '.part'):
+                os.remove(path + '.part')
             try:
-                children = get_folder_children(folder_id)
-            except errors.HttpError, error:
-                logging.warning("HTTP Error: " + error)
-                pass
+                os.link(blob, path + '.part')
+            except (OSError, AttributeError):
+                # The store is on another file system
+                shutil.copyfile(blob, path + '.part')
+        else:
+            logging.debug("Downloading %s to %s", gdrive_file.id, path)
+            # Keep the previous copy until the download completes, an 
+            # interrupted download is resumed from the .part file next time
+            self.api.download_to(path + '.part', gdrive_file.id, resume=True)
+            self.count_file('downloaded')
+        os.rename(path + '.part', path)
+        local_path_table.update(state, ['path'])
+
+    def store_file(self, gdrive_file):
+        """ Returns the path of a file's contents in the content addressed
+        store, downloading them only if no file with the same md5Checksum 
+        has been stored before
+
+        Raises:
+            IOError: The downloaded contents did not match the md5Checksum
+        """
+        md5_checksum = gdrive_file.md5Checksum
+        blob = os.path.join(self.store_path, md5_checksum[:2], md5_checksum)
+        if os.path.exists(blob):
+            logging.debug("Already stored %s", gdrive_file.id)
+            self.count_file('deduplicated')
+            return blob
+        if not os.path.isdir(os.path.dirname(blob)):
+            os.makedirs(os.path.dirname(blob))
+        logging.debug("Downloading %s to %s", gdrive_file.id, blob)
+        self.api.download_to(blob + '.part', gdrive_file.id, resume=True)
+        self.count_file('downloaded')
+        with open(blob + '.part', 'rb') as fd:
+            if file_md5(fd) != md5_checksum:
+                os.remove(blob + '.part')
+                raise IOError("Contents of " + gdrive_file.id 
+                    + " do not match its md5Checksum")
+        os.rename(blob + '.part', blob)
+        return blob
+
+    def count_file(self, result):
+        """ Counts a backed up file by result in the metrics sink """
+        if self.metrics is not None:
+            self.metrics.increment('backup_files_total', result=result)
+
+    def local_path(self, gdrive_file, directory, filename=None):
+        """ Returns the path a file is backed up to within directory, 
+        recording it in the local_path_table so that every file keeps its
+        own path. The file is named filename, by default its title. """
+        local_path_table = self.db['local_path_table']
+        path = contained_path(directory, 
+            filename or safe_filename(gdrive_file.title))
+        owner = local_path_table.find_one(path=path)
+        if owner and owner['file_id'] != gdrive_file.id:
+            base, extension = os.path.splitext(path)
+            path = "%s (%s)%s" % (base, safe_filename(gdrive_file.id), 
+                extension)
+            owner = local_path_table.find_one(path=path)
+        if not owner:
+            local_path_table.insert({
+                "path": path,
+                "file_id": gdrive_file.id
+            })
+        return path
 
     def get_folder_children(self, folder_id):
-        return self.drive_service.children().list(folderId=folder_id).execute()
+        return self.api.execute(
+                self.drive_service.children().list(folderId=folder_id))
 
     def construct_query_dict(self, folder):
         logging.debug("Creaing query string for: " + folder['gdrive_path'])
-        q_string = "title = '" + folder['gdrive_path'] + "' and " \
+        title = folder['gdrive_path'].replace('\\', '\\\\').replace("'", 
+                "\\'")
+        q_string = "title = '" + title + "' and " \
         + " mimeType = 'application/vnd.google-apps.folder'"
         logging.debug("Query string: " + q_string) 
         return {
@@ -128,7 +1131,97 @@ class GDriveBackup:
         }
         
 
+def backup_account(config_path):
+    """ Runs sync for one account of backup_accounts
+
+    Returns:
+        A dictionary of the account's config, the error which failed the
+        backup or None, how many seconds the backup took and a snapshot of
+        its metrics
+    """
+    metrics = InMemoryMetrics()
+    summary = {"config": config_path, "error": None}
+    started = time.time()
+    try:
+        GDriveBackup(config_path, metrics=metrics, interactive=False).sync()
+    except Exception, error:
+        logging.exception("Backing up %s failed", config_path)
+        summary['error'] = "%s: %s" % (type(error).__name__, error)
+    summary['seconds'] = time.time() - started
+    summary['metrics'] = metrics.snapshot()
+    return summary
+
+def backup_accounts(config_paths, processes=None):
+    """ Backs up many accounts at the same time, each in its own process
+    with its own config, credentials, database and quota (see 
+    GDriveBackup). An account which fails doesn't stop the others.
+
+    Args:
+        config_paths: The config of every account
+        processes: Number of accounts backed up at the same time, by 
+                   default the number of CPUs
+
+    Returns:
+        A summary of the run, a dictionary of the summary of every account
+        (see backup_account), the number of accounts which failed, the 
+        counters of every account added together and the seconds the run
+        took
+    """
+    started = time.time()
+    # A fresh process for every account, so no state is shared between 
+    # accounts
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    accounts = []
+    counters = {}
+    try:
+        for summary in pool.imap_unordered(backup_account, config_paths):
+            logging.info("Backed up %s in %.1f seconds%s", summary['config'],
+                summary['seconds'], ", failed with " + summary['error'] 
+                if summary['error'] else "")
+            accounts.append(summary)
+            for counter in summary['metrics']['counters']:
+                key = (counter['name'], 
+                    tuple(sorted(counter['labels'].items())))
+                counters[key] = counters.get(key, 0) + counter['value']
+    finally:
+        pool.close()
+        pool.join()
+    accounts.sort(key=lambda summary: config_paths.index(summary['config']))
+    return {
+        "accounts": accounts,
+        "failed": sum(1 for summary in accounts if summary['error']),
+        "counters": [{"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(counters.items())],
+        "seconds": time.time() - started,
+    }
+
+
 if __name__ == '__main__':
-    gd_backup = GDriveBackup()
+    import argparse
+    parser = argparse.ArgumentParser(description="Backs up Google Drive")
+    parser.add_argument('--config', action='append', metavar='PATH', 
+        help="config of an account to back up, give several to back up "
+        "many accounts at the same time, by default config.json")
+    parser.add_argument('--processes', type=int, help="number of accounts "
+        "backed up at the same time, by default the number of CPUs")
+    parser.add_argument('--watch', metavar='URL', help="keep backing up "
+        "changes as Google Drive notifies URL of them")
+    parser.add_argument('--port', type=int, default=8080, help="port the "
+        "notification server listens on, URL must reach it")
+    parser.add_argument('--worker', action='store_true', help="only help "
+        "with the jobs of a backup run in progress in another process")
+    args = parser.parse_args()
+    logging.basicConfig(filename='gdrive_backup.log', level=logging.INFO)
+    config_paths = args.config or ["config.json"]
+    if len(config_paths) > 1:
+        summary = backup_accounts(config_paths, args.processes)
+        print(json.dumps(summary, indent=2, sort_keys=True))
+        raise SystemExit(1 if summary['failed'] else 0)
+    gd_backup = GDriveBackup(config_paths[0])
     # gd_backup.authenticate()
-    gd_backup.get_list()
+    if args.worker:
+        gd_backup.run_jobs()
+    elif args.watch:
+        gd_backup.watch(args.watch, NotificationServer(('', args.port)))
+    else:
+        gd_backup.sync()
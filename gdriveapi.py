@@ -1,29 +1,400 @@
+import calendar
+import bisect
+import hashlib
+import heapq
 import httplib2
 import json
 import logging
+import os
+import Queue
+import random
+import socket
+import threading
+import time
 
-from pyparsing import (Word, alphas, ParseException, OneOrMore, 
-    ParseResults, alphanums) 
-from apiclient.discovery import build
-from apiclient.http import MediaFileUpload
-from oauth2client.client import OAuth2WebServerFlow
-from oauth2client.file import Storage
-from apiclient import errors
-from collections import namedtuple
+# pyparsing, apiclient and oauth2client take hundreds of milliseconds to
+# import, so they are imported where they are first used
+from collections import deque, namedtuple, OrderedDict
+from contextlib import contextmanager
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
 from pytz import utc
 
-logging.basicConfig(filename='gdriveapi.log', level=logging.DEBUG)
+# files().list parameters which are passed through rather than parsed as
+# query fields
+LIST_PARAMS = ('maxResults', 'pageToken', 'fields', 'orderBy', 'projection',
+    'corpus', 'spaces')
+
+# Longest "q" a files().list request is sent with, longer queries are split
+# across several requests where possible, see GDriveAPI.split_terms
+MAX_QUERY_LENGTH = 4000
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# A minimal projection of file resources, see the default_fields argument of
+# GDriveAPI
+MINIMAL_FIELDS = ('id', 'title', 'mimeType')
+
+def fields_selector(fields, container=None):
+    """ Turns a list of file resource fields into a partial response 
+    selector, leaving selectors which are already strings untouched
+
+    Args:
+        fields: A list of fields, for example ['id', 'parents(id)'], or a
+                selector string such as "items(id,title)"
+        container: The response field holding the file resources, "items"
+                   for files().list responses
+
+    Returns:
+        A selector string, or None if fields is None
+    """
+    if fields is None or isinstance(fields, basestring):
+        return fields
+    selector = ",".join(fields)
+    if container:
+        selector = "%s(%s)" % (container, selector)
+    return selector
+
+# The Drive v2 discovery document is cached on disk, and refreshed in the
+# background once it is older than DISCOVERY_MAX_AGE seconds
+DISCOVERY_URI = 'https://www.googleapis.com/discovery/v1/apis/drive/v2/rest'
+DISCOVERY_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 
+    'gdriveapi', 'drive-v2-discovery.json')
+DISCOVERY_MAX_AGE = 24 * 60 * 60
+# Discovery documents already loaded by this process, keyed by cache path
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+
+def build_drive_service(http, cache_path=None):
+    """ Builds the Google Drive v2 service from the cached discovery 
+    document, so that no request is needed to build it once the cache 
+    exists
+
+    Args:
+        http: The httplib2.Http object the service will use
+        cache_path: Path of the cached discovery document, defaults to 
+                    DISCOVERY_CACHE_PATH
+
+    Returns:
+        The Google Drive service
+    """
+    from apiclient.discovery import build_from_document
+    document = load_discovery_document(cache_path or DISCOVERY_CACHE_PATH)
+    return build_from_document(document, http=http)
+
+def load_discovery_document(cache_path):
+    """ Loads the Drive v2 discovery document from cache_path, fetching it
+    only if the cache doesn't exist yet. A cache older than 
+    DISCOVERY_MAX_AGE is used as is while a background thread refreshes it.
+
+    Returns:
+        The discovery document as a JSON string
+    """
+    with _discovery_lock:
+        if cache_path in _discovery_documents:
+            return _discovery_documents[cache_path]
+        if os.path.exists(cache_path):
+            with open(cache_path) as cache_file:
+                document = cache_file.read()
+            if time.time() - os.path.getmtime(cache_path) > DISCOVERY_MAX_AGE:
+                refresh = threading.Thread(target=refresh_discovery_document,
+                    args=(cache_path,))
+                refresh.daemon = True
+                refresh.start()
+        else:
+            document = fetch_discovery_document(cache_path)
+        _discovery_documents[cache_path] = document
+        return document
+
+def fetch_discovery_document(cache_path):
+    """ Fetches the Drive v2 discovery document and writes it to cache_path
+
+    Returns:
+        The discovery document as a JSON string
+
+    Raises:
+        IOError: The discovery document could not be fetched
+    """
+    resp, content = httplib2.Http().request(DISCOVERY_URI)
+    if resp.status != 200:
+        raise IOError("Could not fetch discovery document: %s" % resp)
+    # Validate the document before caching it
+    json.loads(content)
+    try:
+        directory = os.path.dirname(cache_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Write to a temporary file first so readers never see a partial file
+        temp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        with open(temp_path, 'w') as cache_file:
+            cache_file.write(content)
+        os.rename(temp_path, cache_path)
+    except (IOError, OSError) as error:
+        logging.warning("Could not cache discovery document: %s", error)
+    return content
+
+def refresh_discovery_document(cache_path):
+    """ Refreshes the cached discovery document, run in the background """
+    try:
+        fetch_discovery_document(cache_path)
+    except Exception as error:
+        logging.warning("Could not refresh discovery document: %s", error)
+
+# Google Drive accepts at most this many calls in a single batch request
+BATCH_SIZE = 100
+BATCH_URI = 'https://www.googleapis.com/batch/drive/v2'
+# Status codes worth retrying, 403s are only retried for rate limit reasons
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+def is_retryable(error):
+    """ Determines if a failed request is worth sending again
+
+    Args:
+        error: An apiclient.errors.HttpError
+
+    Returns:
+        True if the request failed because of a rate limit or server error
+    """
+    status = getattr(error.resp, 'status', None)
+    if status in RETRY_STATUSES:
+        return True
+    if status == 403:
+        return any(reason in error.content for reason in RATE_LIMIT_REASONS)
+    return False
+
+def execute_batch(requests, retries=3, http=None, executor=None):
+    """ Executes many requests through the Google Drive batch endpoint,
+    sending BATCH_SIZE requests per round trip. Requests which fail with a
+    rate limit or server error are retried with exponential backoff.
+
+    Args:
+        requests: A dictionary of request ids to apiclient HttpRequests
+        retries: Number of times a failed request will be retried
+        http: httplib2.Http object to send the batches with, defaults to
+              the Http object of the first request
+        executor: An optional RequestExecutor which rate limits the batches
+                  and paces the retries
+
+    Returns:
+        A tuple of two dictionaries keyed by request id, the first holds the
+        responses of successful requests and the second the HttpErrors of
+        failed requests
+    """
+    from apiclient import errors
+    from apiclient.http import BatchHttpRequest
+    responses = {}
+    failures = {}
+    pending = list(requests)
+    for attempt in xrange(retries + 1):
+        retry = []
+        quota_errors = []
+        def callback(request_id, response, exception):
+            if exception is None:
+                responses[request_id] = response
+                failures.pop(request_id, None)
+            else:
+                failures[request_id] = exception
+                if isinstance(exception, errors.HttpError) and \
+                        is_retryable(exception):
+                    retry.append(request_id)
+                    if exception.resp.status in (403, 429):
+                        quota_errors.append(request_id)
+        for x in xrange(0, len(pending), BATCH_SIZE):
+            batch = BatchHttpRequest(callback=callback, batch_uri=BATCH_URI)
+            for request_id in pending[x:x + BATCH_SIZE]:
+                batch.add(requests[request_id], request_id=request_id)
+            if executor is None:
+                batch.execute(http=http)
+            else:
+                executor.call(batch.execute, http=http)
+        if not retry or attempt == retries:
+            break
+        logging.debug("Retrying %d batched requests", len(retry))
+        if executor is None:
+            time.sleep(2 ** attempt)
+        else:
+            if quota_errors:
+                executor.throttled()
+            time.sleep(executor.backoff(attempt))
+        pending = retry
+    return responses, failures
+
+def request_range(http, url, headers):
+    """ Requests part of a file, raising an HttpError for responses worth
+    retrying so that a RequestExecutor retries them """
+    from apiclient import errors
+    resp, content = http.request(url, headers=headers)
+    error = errors.HttpError(resp, content, uri=url)
+    if resp.status >= 400 and is_retryable(error):
+        raise error
+    return resp, content
+
+def file_md5(fd):
+    """ Returns the hex MD5 digest of everything in a readable file object
+    """
+    digest = hashlib.md5()
+    fd.seek(0)
+    for chunk in iter(lambda: fd.read(DOWNLOAD_CHUNK_SIZE), ''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+# Number of bytes requested at a time when downloading
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Number of bytes of files download_many downloads at the same time
+DOWNLOAD_INFLIGHT_BYTES = 256 * 1024 * 1024
+# The file resource fields download_many needs
+DOWNLOAD_FIELDS = ('id', 'title', 'mimeType', 'modifiedDate', 'fileSize', 
+    'downloadUrl', 'exportLinks', 'md5Checksum', 'etag')
+
+# The formats Google Docs are exported in, most preferred first, keyed by
+# the mimeType of the Google Doc
+EXPORT_FORMATS = {
+    'application/vnd.google-apps.document': [
+        'application/vnd.openxmlformats-officedocument.wordprocessingml.'
+            'document',
+        'application/vnd.oasis.opendocument.text',
+        'application/pdf',
+        'text/plain',
+    ],
+    'application/vnd.google-apps.spreadsheet': [
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        'application/x-vnd.oasis.opendocument.spreadsheet',
+        'application/pdf',
+        'text/csv',
+    ],
+    'application/vnd.google-apps.presentation': [
+        'application/vnd.openxmlformats-officedocument.presentationml.'
+            'presentation',
+        'application/pdf',
+        'text/plain',
+    ],
+    'application/vnd.google-apps.drawing': [
+        'image/svg+xml',
+        'image/png',
+        'application/pdf',
+    ],
+}
+# File name extensions of the export formats
+EXPORT_EXTENSIONS = {
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
+        '.docx',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet':
+        '.xlsx',
+    'application/vnd.openxmlformats-officedocument.presentationml.'
+        'presentation': '.pptx',
+    'application/vnd.oasis.opendocument.text': '.odt',
+    'application/x-vnd.oasis.opendocument.spreadsheet': '.ods',
+    'application/pdf': '.pdf',
+    'application/rtf': '.rtf',
+    'application/zip': '.zip',
+    'text/plain': '.txt',
+    'text/html': '.html',
+    'text/csv': '.csv',
+    'image/svg+xml': '.svg',
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+}
+
+def drive_time(value):
+    """ Converts a Google Drive RFC 3339 timestamp in UTC, such as 
+    2013-10-01T12:00:00.000Z, to seconds since the epoch """
+    return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+
+def safe_filename(title):
+    """ Turns a Google Drive title into a single local path component. 
+    Titles may contain slashes or be "..", neither of which may escape the
+    directory a file is saved into.
+    """
+    name = title.replace('/', '_').replace('\\', '_').replace('\0', '')
+    if name.strip('.') == '':
+        # "", "." and ".." would name the directory or its parent
+        name = '_' + name
+    return name
+
+# Number of bytes sent at a time when uploading, a multiple of 256KB
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+# Resumable upload sessions are stored in UPLOAD_STATE_DIR until the upload
+# completes, one file per uploaded path
+UPLOAD_STATE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 
+    'gdriveapi', 'uploads')
+
+def query_upload(http, uri, size):
+    """ Asks Google Drive how much of a resumable upload session it has
+    received, raising an HttpError for any response other than 308 (upload
+    incomplete), 200 or 201 (upload complete) so that a RequestExecutor 
+    retries the ones worth retrying
+
+        Returns:
+            A tuple of the number of bytes received and the uploaded file
+            resource, which is None until the upload is complete
+    """
+    from apiclient import errors
+    resp, content = http.request(uri, 'PUT', headers={
+        'Content-Range': 'bytes */%d' % size, 'Content-Length': '0'})
+    if resp.status in (200, 201):
+        return size, json.loads(content)
+    if resp.status != 308:
+        raise errors.HttpError(resp, content, uri=uri)
+    if 'range' not in resp:
+        return 0, None
+    # Range: bytes=0-<last byte received>
+    return int(resp['range'].split('-')[-1]) + 1, None
+
+# GDriveFile namedtuple types, keyed by their sorted field names
+_gdrive_file_types = {}
+
+def gdrive_file_type(keys):
+    """ Returns the GDriveFile namedtuple type for a set of keys, creating
+    it only the first time that set of keys is seen. Google Drive returns
+    the same handful of key sets for every file in a listing, so this avoids
+    building a new class per file.
+
+    Args:
+        keys: The keys of a file resource dictionary
+
+    Returns:
+        A namedtuple type named GDriveFile
+    """
+    fields = tuple(sorted(keys))
+    try:
+        return _gdrive_file_types[fields]
+    except KeyError:
+        GDriveFile = namedtuple('GDriveFile', fields)
+        _gdrive_file_types[fields] = GDriveFile
+        return GDriveFile
 
 class GDriveAPI(object):
 
-    def __init__(self, credentials_file=None, **config_kwargs):
+    def __init__(self, credentials_file=None, cache=None, transport=None,
+            executor=None, upload_state_dir=None, default_fields=None,
+            export_formats=None, metrics=None, **config_kwargs):
         """ Instantiates a GDriveAPI class. Will use the provided 
         credentials file or the config file, at LEAST one must be
         provided
         
         Args:
             credentials_file: A generated oauth2client.file.Storage file.
+            cache: An optional ResponseCache used to answer repeated list
+                   and get requests
+            transport: A callable which is given the credentials and returns
+                   the transport requests are sent with, ThreadLocalTransport
+                   by default. See also PooledTransport.
+            executor: The RequestExecutor every request is sent through,
+                   which rate limits requests and retries rate limited and
+                   failed requests
+            upload_state_dir: Directory resumable upload sessions are kept
+                   in, UPLOAD_STATE_DIR by default
+            default_fields: File resource fields requested by listings that
+                   aren't given fields, for example MINIMAL_FIELDS. By 
+                   default whole file resources are requested.
+            export_formats: The formats Google Docs are exported in when 
+                   they are downloaded, EXPORT_FORMATS by default
+            metrics: An optional metrics sink, such as InMemoryMetrics, 
+                   which is given request latencies, bytes transferred, 
+                   retries, cache results and pages fetched
 
             client_id: Your application's client_id
             client_secret: Your application's client secret
@@ -33,6 +404,7 @@ class GDriveAPI(object):
         Returns:
             An instantiated and authenticated GDriveAPI
         """ 
+        from oauth2client.file import Storage
         # Determine if a credentials file was providied
         if not credentials_file:
             # If no file was provided, authenticate the user given the kwargs
@@ -58,8 +430,18 @@ class GDriveAPI(object):
         # Create a drive service to be used by the class
         http = httplib2.Http()
         http = self.credentials.authorize(http)
-        self.drive_service = build('drive', 'v2', http=http)
+        self.drive_service = build_drive_service(http)
         self.parser = GDriveAPIParser()
+        self.transport = (transport or ThreadLocalTransport)(self.credentials)
+        self.executor = executor or RequestExecutor()
+        self.metrics = metrics
+        if self.executor.metrics is None:
+            self.executor.metrics = metrics
+        self.cache = cache
+        self.upload_state_dir = upload_state_dir or UPLOAD_STATE_DIR
+        self.default_fields = default_fields
+        self.max_query_length = MAX_QUERY_LENGTH
+        self.export_formats = export_formats or EXPORT_FORMATS
         self.op_map = {
             'lte': '<=', 
             'lt':  '<',
@@ -77,6 +459,7 @@ class GDriveAPI(object):
         redirect_url: The redirect_url for your application
 
         """
+        from oauth2client.client import OAuth2WebServerFlow
         flow = OAuth2WebServerFlow(client_id, client_secret, scopes, redirect_url)
         # Follow the steps for authentication
         authorize_url = flow.step1_get_authorize_url()
@@ -91,8 +474,8 @@ class GDriveAPI(object):
         query and converts the items into objects using nametuples for
         convenience of the API user 
 
-        Constructs namedtuples after the keys of the largest dict returned in 
-        the items list
+        Constructs namedtuples after the keys of each dict returned in the
+        items list, reusing one GDriveFile type per distinct set of keys
         
         Args:
             files - The items list of a successful response, that is
@@ -103,11 +486,11 @@ class GDriveAPI(object):
         """
         file_list = []
         for f in files:
-            GDriveFile = namedtuple('GDriveFile', f.keys())
+            GDriveFile = gdrive_file_type(f.keys())
             file_list.append(GDriveFile(**f))
         return file_list
  
-    def get_folder(self, **kwargs):
+    def get_folder(self, *expressions, **kwargs):
         """ Retrieves one or more folder from Google Drive. This function
             will return folders and ONLY folders since it appends
                 "and mimeType = 'application/vnd.google-aps.folder'
@@ -117,6 +500,7 @@ class GDriveAPI(object):
             get_file() method.
     
             Args:
+            *expressions: Query expressions, see get_file_info
             **kwargs: Accepts any query parameters that are valid Google Drive
                       SDK requests.
                       
@@ -142,20 +526,20 @@ class GDriveAPI(object):
 
         """
         # Parse kwargs to ensure they're valid
-        logging.debug("Getting folder, options passed in: " 
-        + str(kwargs)) 
-        tokens = self.parser.parse(**kwargs)
-        query = self.construct_query(tokens)
-        query['q'] += (" and mimeType = "
-        "'application/vnd.google-apps.folder'")
-        logging.info("Final query is: " + str(query))
-        folders = self.drive_service.files().list(**query).execute()
-        return self.create_gdrive_files(folders['items'])
-
-    def get_file_info(self, **kwargs):
+        logging.debug("Getting folder, options passed in: %s", kwargs)
+        expressions += (Q(mimeType=FOLDER_MIME_TYPE),)
+        return list(self.iter_files(*expressions, **kwargs))
+
+    def get_file_info(self, *expressions, **kwargs):
         """ Retrieves one or more files from Google Drive
 
         Args:
+            *expressions: Query expressions (see Q) which must match as well
+                      as the keyword arguments, combined with & (and), 
+                      | (or) and ~ (not), for example
+
+                        Q(title_contains="blue") | ~Q(starred=True)
+
             **kwargs: Accepts any query parameters that are valid Google Drive
                       SDK requests.
                       
@@ -173,24 +557,193 @@ class GDriveAPI(object):
                       parameter:
                         
                         title_contains="blue"
+
+                      The "in" operator also accepts a list of values, 
+                      matching files with any of them, for example
+
+                        parents_in=[FOLDER_ID, OTHER_FOLDER_ID]
         Returns:
             
             GDriveFile objects (namedtuples) so that the returned results can
             be accessed as typical objects.
 
         """
-        logging.debug("Getting file, options passed in: "
-        + str(kwargs))
-        tokens = self.parser.parse(**kwargs)
-        query = self.construct_query(tokens)
-        logging.info("Final query is: " + str(query))
-        files = self.drive_service.files().list(**query).execute()
-        return self.create_gdrive_files(files['items'])
+        logging.debug("Getting file, options passed in: %s", kwargs)
+        return list(self.iter_files(*expressions, **kwargs))
+
+    def iter_files(self, *expressions, **kwargs):
+        """ Lazily retrieves one or more files from Google Drive, following
+        nextPageToken until every matching file has been returned. Files are
+        yielded as each page arrives, so only one page is held in memory.
+
+        A query longer than max_query_length is split into several 
+        files().list requests, and a file matched by more than one of them 
+        is only returned once.
+
+        Args:
+            *expressions, **kwargs: Accepts the same query expressions and 
+                      parameters as get_file_info.
+
+                      In addition the following files().list parameters are
+                      passed through untouched:
+
+                        maxResults: Number of files to request per page
+                        fields: The file resource fields to request, for
+                            example ['id', 'title'], or a partial response
+                            selector such as "items(id,title)"
+                        orderBy, pageToken, projection, corpus, spaces
+
+        Returns:
+            A generator of GDriveFile objects (namedtuples)
+
+        """
+        queries = self.construct_list_queries(*expressions, **kwargs)
+        logging.info("Final queries are: %s", queries)
+        if len(queries) == 1:
+            return self.iter_query(queries[0])
+        return unique_files(self.iter_query(query) for query in queries)
 
+    def iter_query(self, query):
+        """ Executes a files().list query page by page
+
+        Args:
+            query: A dictionary of files().list parameters, usually the
+                   result of construct_list_query
+
+        Returns:
+            A generator of GDriveFile objects (namedtuples)
+        """
+        query = dict(query)
+        while True:
+            response = self.list_page(query)
+            for gdrive_file in self.create_gdrive_files(
+                    response.get('items', [])):
+                yield gdrive_file
+            # Stop once Google Drive has no more pages for this query
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+            query['pageToken'] = page_token
+
+    def list_page(self, query):
+        """ Executes a single files().list request
+
+        Args:
+            query: A dictionary of files().list parameters, including the
+                   pageToken of the page to request
+
+        Returns:
+            The files().list response
+        """
+        if self.metrics is not None:
+            self.metrics.increment('gdrive_pages_total')
+        return self.execute_cached(('files.list', query),
+            self.drive_service.files().list(**query))
     
-    def get_folder_contents(self, folder_id, **kwargs):
+    def query_many(self, queries, workers=4, order_by=None):
+        """ Runs several queries at the same time, returning the files
+        matched by any of them as their pages arrive, so that the queries
+        take about as long as the slowest of them rather than all of them.
+        A file matched by more than one query is only returned once.
+
+        Args:
+            queries: A list of dictionaries of query parameters, as accepted
+                     by get_file_info
+            workers: Number of queries to run at the same time
+            order_by: A file field, optionally followed by " desc", to
+                      return the files ordered by, for example
+                      "modifiedDate desc". Every query is sent with it as
+                      orderBy and the ordered listings are merged, so it
+                      must be a field Google Drive orders by and the fields
+                      requested must include it.
+
+        Returns:
+            A generator of GDriveFile objects (namedtuples)
+        """
+        listings = []
+        for query in queries:
+            query = dict(query)
+            if order_by:
+                query['orderBy'] = order_by
+            listings.extend(self.construct_list_queries(**query))
+        results = Queue.Queue()
+        stop = threading.Event()
+        def run_listing(x):
+            # Files are put as (listing, file, error), a file of None marks
+            # the end of the listing
+            try:
+                for gdrive_file in self.iter_query(listings[x]):
+                    if stop.is_set():
+                        return
+                    results.put((x, gdrive_file, None))
+                results.put((x, None, None))
+            except Exception, error:
+                results.put((x, None, error))
+        pool = ThreadPool(max(1, min(workers, len(listings))))
+        for x in xrange(len(listings)):
+            pool.apply_async(run_listing, (x,))
+        if order_by:
+            files = self.merge_listings(results, len(listings), order_by)
+        else:
+            files = self.receive_listings(results, len(listings))
+        seen = set()
+        try:
+            for gdrive_file in files:
+                if gdrive_file.id not in seen:
+                    seen.add(gdrive_file.id)
+                    yield gdrive_file
+        finally:
+            stop.set()
+            pool.terminate()
+            pool.join()
+
+    def receive_listings(self, results, count):
+        """ Returns the files of count listings run by query_many in the
+        order they arrive """
+        while count:
+            x, gdrive_file, error = results.get()
+            if error is not None:
+                raise error
+            if gdrive_file is None:
+                count -= 1
+            else:
+                yield gdrive_file
+
+    def merge_listings(self, results, count, order_by):
+        """ Merges the files of count listings run by query_many, each
+        ordered by order_by, into one ordered listing """
+        field, _, direction = order_by.partition(' ')
+        descending = direction.strip() == 'desc'
+        buffers = [deque() for x in xrange(count)]
+        finished = [False] * count
+        heap = []
+        def push(x):
+            # Wait for the next file of listing x, buffering the files of
+            # the other listings which arrive first
+            while not buffers[x] and not finished[x]:
+                y, gdrive_file, error = results.get()
+                if error is not None:
+                    raise error
+                if gdrive_file is None:
+                    finished[y] = True
+                else:
+                    buffers[y].append(gdrive_file)
+            if buffers[x]:
+                gdrive_file = buffers[x].popleft()
+                # The listing number breaks ties, so files are never
+                # compared
+                heapq.heappush(heap, (SortKey(getattr(gdrive_file, field,
+                    None), descending), x, gdrive_file))
+        for x in xrange(count):
+            push(x)
+        while heap:
+            _, x, gdrive_file = heapq.heappop(heap)
+            yield gdrive_file
+            push(x)
+
+    def get_folder_contents(self, folder_id, *expressions, **kwargs):
         """ Retrieves one or more files from Google Drive which reside in the 
-            folder with the specified id.
+            folder with the specified id, or in any of a list of folder ids.
 
             This method is a shorthand for the method 
                 get_file(parents_in=[FOLDER_ID]
@@ -219,14 +772,48 @@ class GDriveAPI(object):
 
         """
         kwargs['parents_in'] = folder_id
-        return self.get_file_info(**kwargs) 
+        return self.get_file_info(*expressions, **kwargs) 
+
+    def get_many(self, ids, fields=None, retries=3):
+        """ Retrieves the metadata of many files by id, sending up to 
+        BATCH_SIZE lookups per round trip to Google Drive
+
+        Args:
+            ids: An iterable of file ids
+            fields: The file resource fields to request, for example 
+                    ['id', 'title'] or "id,title"
+            retries: Number of times a rate limited or failed lookup is 
+                     retried
+
+        Returns:
+            A tuple of two dictionaries keyed by file id, the first holds
+            GDriveFile objects (namedtuples) and the second holds the 
+            apiclient.errors.HttpError of each file that could not be 
+            retrieved
+        """
+        requests = {}
+        for file_id in ids:
+            params = {'fileId': file_id}
+            if fields:
+                params['fields'] = fields_selector(fields)
+            requests[file_id] = self.drive_service.files().get(**params)
+        responses, failures = self.execute_batch(requests, retries)
+        files = {}
+        for file_id, response in responses.items():
+            files[file_id] = self.create_gdrive_files([response])[0]
+        return files, failures
 
     def upload_file(self, filepath, convert=None, 
             useContentAsIndexableText=None,
             visibility=None, ocrLanguage=None, 
             ocr=None, timedTextLanguage=None, 
-            timedTextTrackName=None, pinned=None, **kwargs):
-        """ Uploads a file
+            timedTextTrackName=None, pinned=None, 
+            chunk_size=UPLOAD_CHUNK_SIZE, progress=None, **kwargs):
+        """ Uploads a file using a resumable upload, chunk_size bytes at a 
+        time. The upload session is persisted in upload_state_dir until the
+        upload completes, so uploading the same file again after an 
+        interruption resumes the previous session, as long as the file's 
+        size and modification time haven't changed since.
 
             Args:
                 filepath: Path of file to upload, String
@@ -278,10 +865,207 @@ class GDriveAPI(object):
                 
                 title:	string	The title of the this file. Used to identify 
                     file or folder name.
+
+            Upload Args:
+                chunk_size: Number of bytes to send per request, must be a
+                    multiple of 256KB
+                
+                progress: Optional callable, called after every chunk with 
+                    the number of bytes uploaded so far and the file size
+
+            Returns:
+                A GDriveFile (namedtuple) of the uploaded file
+        """
+        from apiclient import errors
+        from apiclient.http import MediaFileUpload
+        params = {
+            'convert': convert,
+            'useContentAsIndexableText': useContentAsIndexableText,
+            'visibility': visibility,
+            'ocrLanguage': ocrLanguage,
+            'ocr': ocr,
+            'timedTextLanguage': timedTextLanguage,
+            'timedTextTrackName': timedTextTrackName,
+            'pinned': pinned,
+        }
+        params = dict((k, v) for k, v in params.items() if v is not None)
+        body = dict(kwargs)
+        body.setdefault('title', os.path.basename(filepath))
+        if 'parents' in body:
+            # Allow parents to be given as a list of folder ids
+            body['parents'] = [{'id': parent} 
+                if isinstance(parent, basestring) else parent
+                for parent in body['parents']]
+        media = MediaFileUpload(filepath, mimetype=body.get('mimeType'),
+            chunksize=chunk_size, resumable=True)
+        request = self.drive_service.files().insert(body=body, 
+            media_body=media, **params)
+        session_file = self.upload_session_path(filepath)
+        stat = os.stat(filepath)
+        session = {'uri': None, 'size': stat.st_size, 'mtime': stat.st_mtime}
+        response = None
+        with self.transport.connection() as http:
+            previous = self.load_upload_session(session_file)
+            if previous and (previous.get('size'), previous.get('mtime')) \
+                    == (session['size'], session['mtime']):
+                # Ask Google Drive how much of the file it already has
+                logging.debug("Resuming upload of " + filepath)
+                try:
+                    request.resumable_progress, response = \
+                        self.executor.call(query_upload, http, 
+                            previous['uri'], media.size())
+                    request.resumable_uri = session['uri'] = previous['uri']
+                except errors.HttpError as error:
+                    if error.resp.status not in (404, 410):
+                        raise
+                    logging.debug("Upload session of %s expired", filepath)
+            elif previous:
+                logging.debug("%s changed since its upload was interrupted",
+                    filepath)
+            while response is None:
+                sent = request.resumable_progress
+                start = time.time()
+                try:
+                    status, response = self.executor.call(
+                        request.next_chunk, http=http)
+                except errors.HttpError as error:
+                    if request.resumable_uri and \
+                            error.resp.status in (404, 410):
+                        # The upload session expired, start a new one
+                        logging.debug("Restarting upload of " + filepath)
+                        request.resumable_uri = session['uri'] = None
+                        request.resumable_progress = 0
+                        continue
+                    raise
+                if self.metrics is not None:
+                    self.metrics.observe('gdrive_request_seconds', 
+                        time.time() - start, endpoint='upload')
+                    self.metrics.increment('gdrive_upload_bytes_total', 
+                        (status.resumable_progress if status else 
+                            media.size()) - sent)
+                if response is None and \
+                        session['uri'] != request.resumable_uri:
+                    session['uri'] = request.resumable_uri
+                    self.save_upload_session(session_file, session)
+                if progress and status:
+                    progress(status.resumable_progress, status.total_size)
+        if os.path.exists(session_file):
+            os.remove(session_file)
+        if self.cache is not None:
+            # Cached listings may no longer be complete
+            self.cache.invalidate()
+        if progress:
+            progress(media.size(), media.size())
+        return self.create_gdrive_files([response])[0]
+
+    def upload_session_path(self, filepath):
+        """ Returns the path the upload session of filepath is kept in
+        """
+        key = hashlib.md5(os.path.abspath(filepath)).hexdigest()
+        return os.path.join(self.upload_state_dir, key + '.json')
+
+    def load_upload_session(self, session_file):
+        """ Returns the upload session stored in session_file, or None if
+        there isn't a readable one
+        """
+        try:
+            with open(session_file) as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return None
+
+    def save_upload_session(self, session_file, session):
+        """ Stores an upload session, writing it to a temporary file first 
+        so an interruption never leaves a partially written session behind
+        """
+        if not os.path.isdir(self.upload_state_dir):
+            try:
+                os.makedirs(self.upload_state_dir)
+            except OSError:
+                # Created by another thread in the meantime
+                pass
+        with open(session_file + '.tmp', 'w') as fd:
+            json.dump(session, fd)
+        os.rename(session_file + '.tmp', session_file)
+
+    def upload_many(self, filepaths, workers=4, **kwargs):
+        """ Uploads many files at once using a pool of worker threads
+
+            Args:
+                filepaths: Paths of the files to upload
+                workers: Number of files to upload at the same time
+                kwargs: Passed to upload_file for every file
+
+            Returns:
+                A tuple of two dictionaries keyed by file path, the first 
+                holds a GDriveFile for every uploaded file and the second 
+                holds the exception raised by every file that failed
+        """
+        def upload(filepath):
+            try:
+                return filepath, self.upload_file(filepath, **kwargs), None
+            except Exception as error:
+                logging.warning("Upload of %s failed: %s", filepath, error)
+                return filepath, None, error
+        files = {}
+        failures = {}
+        pool = ThreadPool(workers)
+        try:
+            for filepath, gdrive_file, error in pool.imap_unordered(upload,
+                    filepaths):
+                if error is None:
+                    files[filepath] = gdrive_file
+                else:
+                    failures[filepath] = error
+        finally:
+            pool.close()
+            pool.join()
+        return files, failures
+
+    def execute(self, request):
+        """ Executes an apiclient HttpRequest using a connection from the
+        transport, so that it is safe to call from several threads
+
+        Args:
+            request: The apiclient HttpRequest to execute
+
+        Returns:
+            The response of the request
         """
-        pass
+        if self.metrics is None:
+            with self.transport.connection() as http:
+                return self.executor.call(request.execute, http=http)
+        endpoint = getattr(request, 'methodId', None) or 'unknown'
+        postproc = request.postproc
+        def count_bytes(resp, content):
+            self.metrics.increment('gdrive_response_bytes_total', 
+                len(content), endpoint=endpoint)
+            return postproc(resp, content)
+        request.postproc = count_bytes
+        with self.metrics.timer('gdrive_request_seconds', endpoint=endpoint):
+            with self.transport.connection() as http:
+                return self.executor.call(request.execute, http=http)
+
+    def execute_batch(self, requests, retries=3):
+        """ Executes many requests through the Google Drive batch endpoint,
+        see execute_batch
+
+        Returns:
+            A tuple of two dictionaries keyed by request id, the first holds
+            the responses of successful requests and the second the 
+            HttpErrors of failed requests
+        """
+        if self.metrics is None:
+            with self.transport.connection() as http:
+                return execute_batch(requests, retries, http, self.executor)
+        self.metrics.increment('gdrive_batched_requests_total', len(requests))
+        with self.metrics.timer('gdrive_request_seconds', endpoint='batch'):
+            with self.transport.connection() as http:
+                return execute_batch(requests, retries, http, self.executor)
+
     def download_file(self, id=None, **kwargs):
-        """ Retrieves the contents of the specified file
+        """ Retrieves the contents of the specified file, Google Docs are
+        exported in the format chosen by export_format
            
             Arguments:
                 id: ID of the file to retrieve
@@ -296,6 +1080,288 @@ class GDriveAPI(object):
                 IOError: Google returned a 404 for the specified file ID,
                          the file could not be found.
         """
+        content = StringIO()
+        self.download_to(content, id, **kwargs)
+        # Return the content of the file
+        return content.getvalue()
+
+    def download_to(self, destination, id=None, 
+            chunk_size=DOWNLOAD_CHUNK_SIZE, progress=None, resume=False,
+            **kwargs):
+        """ Streams the contents of the specified file to disk, requesting
+        chunk_size bytes at a time with Range requests so that only one chunk
+        is held in memory. Google Docs are exported in the format chosen by
+        export_format. A downloaded path is given the file's modifiedDate as
+        its modification time.
+
+            Arguments:
+                destination: Path or writable file object to download to
+                id: ID of the file to retrieve
+                chunk_size: Number of bytes to request at a time
+                progress: Optional callable, called after every chunk with
+                          the number of bytes downloaded so far and the 
+                          total size of the file (None if unknown)
+                resume: If destination is a path to a partially downloaded
+                        file, continue from the end of that file instead of
+                        overwriting it. The remaining bytes are requested 
+                        with If-Range, and the finished file is checked 
+                        against md5Checksum, so a file which changed since 
+                        the partial download is downloaded again from the
+                        start.
+
+            kwargs:
+                Valid Google Drive queries
+
+            Returns:
+                The number of bytes in the downloaded file
+
+            Raises:
+                ValueError: Multiple files were found, query was not specific
+                            enough
+
+                IOError: Google returned a 404 for the specified file ID,
+                         the file could not be found.
+        """
+        return self.download_resource_to(self.get_file_resource(id, **kwargs),
+            destination, chunk_size, progress, resume)
+
+    def download_resource_to(self, gdrive_file, destination, 
+            chunk_size=DOWNLOAD_CHUNK_SIZE, progress=None, resume=False):
+        """ Streams the contents of a file resource (a dictionary) to disk 
+        without looking the file up first, see download_to
+
+            Returns:
+                The number of bytes in the downloaded file
+        """
+        # Determine if there was a rreturn or if a downloadURL exists
+        url = gdrive_file.get('downloadUrl')
+        if not url:
+            # Google Docs have no content of their own, but can be exported
+            export_format = self.export_format(gdrive_file.get('mimeType'),
+                gdrive_file.get('exportLinks'))
+            if export_format is None:
+                # Let the user know the file couldn't be found
+                raise IOError("File with id " + str(gdrive_file['id']) 
+                    + " could not be found")
+            url = gdrive_file['exportLinks'][export_format]
+            # Each export is generated afresh, so a partial export can't
+            # be continued
+            resume = False
+        total = gdrive_file.get('fileSize')
+        if total is not None:
+            total = int(total)
+        resumed = False
+        if isinstance(destination, basestring):
+            if resume and os.path.exists(destination):
+                # Resume from the end of a partially downloaded file
+                fd = open(destination, 'r+b')
+                fd.seek(0, os.SEEK_END)
+                if total is not None and fd.tell() > total:
+                    # Longer than the file can be, so it isn't a prefix
+                    fd.seek(0)
+                    fd.truncate()
+                resumed = fd.tell() > 0
+            else:
+                fd = open(destination, 'wb')
+        else:
+            fd = destination
+        try:
+            offset = self.download_ranges(fd, url, total, chunk_size, 
+                progress, gdrive_file.get('etag') if resumed else None)
+            md5_checksum = gdrive_file.get('md5Checksum')
+            if resumed and md5_checksum and file_md5(fd) != md5_checksum:
+                logging.warning("Partial download of %s no longer matches, "
+                    "downloading it again", gdrive_file['id'])
+                fd.seek(0)
+                fd.truncate()
+                offset = self.download_ranges(fd, url, total, chunk_size,
+                    progress)
+        finally:
+            if fd is not destination:
+                fd.close()
+        if fd is not destination and gdrive_file.get('modifiedDate'):
+            # Lets an unchanged file be recognised by its modification time
+            modified = drive_time(gdrive_file['modifiedDate'])
+            os.utime(destination, (modified, modified))
+        return offset
+
+    def export_format(self, mime_type, export_links):
+        """ Chooses the format a Google Doc is exported in, the first of
+        the export_formats preferred for its mimeType that it can be 
+        exported in
+
+            Args:
+                mime_type: mimeType of the Google Doc
+                export_links: exportLinks of the Google Doc, a dictionary of
+                              mimeTypes to export urls
+
+            Returns:
+                The chosen mimeType, or None if the file can't be exported
+        """
+        if not export_links:
+            return None
+        for export_format in self.export_formats.get(mime_type, ()):
+            if export_format in export_links:
+                return export_format
+        # Any format is better than none
+        return sorted(export_links)[0]
+
+    def export_filename(self, gdrive_file):
+        """ Returns the local file name of a file resource (a dictionary),
+        its title passed through safe_filename with the extension of the 
+        export format of a Google Doc appended """
+        filename = safe_filename(gdrive_file['title'])
+        if not gdrive_file.get('downloadUrl'):
+            export_format = self.export_format(gdrive_file.get('mimeType'),
+                gdrive_file.get('exportLinks'))
+            filename += EXPORT_EXTENSIONS.get(export_format, '')
+        return filename
+
+    def download_many(self, query_or_ids, dest_dir, workers=4, 
+            max_inflight_bytes=DOWNLOAD_INFLIGHT_BYTES, 
+            chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """ Downloads many files into dest_dir using a pool of worker 
+        threads. The largest files are started first so that a large file
+        doesn't hold up the end of the run, and files are only started while
+        fewer than max_inflight_bytes are being downloaded. Each file is 
+        streamed to disk chunk_size bytes at a time.
+
+        Files are saved under their title, passed through safe_filename, a
+        title already used by another downloaded file gets the file id 
+        appended. Google Docs are exported, see export_formats.
+
+            Args:
+                query_or_ids: A dictionary of query parameters, as accepted
+                              by get_file_info, or an iterable of file ids
+                dest_dir: Directory to download the files into
+                workers: Number of files to download at the same time
+                max_inflight_bytes: Number of bytes of files which can be
+                              downloading at the same time, a file larger
+                              than this is downloaded on its own
+                chunk_size: Number of bytes to request at a time
+
+            Returns:
+                A tuple of two dictionaries keyed by file id, the first 
+                holds the path of every downloaded file and the second holds
+                the exception raised by every file that failed
+        """
+        if isinstance(query_or_ids, dict):
+            query = dict(query_or_ids, fields=DOWNLOAD_FIELDS)
+            resources = [gdrive_file._asdict() 
+                for gdrive_file in self.iter_files(**query)]
+            failures = {}
+        else:
+            files, failures = self.get_many(query_or_ids, 
+                fields=DOWNLOAD_FIELDS)
+            resources = [gdrive_file._asdict() 
+                for gdrive_file in files.values()]
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        paths = {}
+        destinations = set()
+        for resource in resources:
+            path = os.path.join(dest_dir, self.export_filename(resource))
+            if path in destinations:
+                base, extension = os.path.splitext(path)
+                path = "%s (%s)%s" % (base, safe_filename(resource['id']),
+                    extension)
+            destinations.add(path)
+            paths[resource['id']] = path
+        # Largest first, files of unknown size last
+        resources.sort(key=lambda resource: -int(resource.get('fileSize') 
+            or 0))
+        budget = ByteBudget(max_inflight_bytes)
+        def download(resource):
+            size = int(resource.get('fileSize') or chunk_size)
+            try:
+                with budget.reserve(size):
+                    self.download_resource_to(resource, 
+                        paths[resource['id']], chunk_size)
+                return resource['id'], None
+            except Exception as error:
+                logging.warning("Download of %s failed: %s", 
+                    resource['id'], error)
+                return resource['id'], error
+        downloaded = {}
+        pool = ThreadPool(workers)
+        try:
+            for file_id, error in pool.imap_unordered(download, resources):
+                if error is None:
+                    downloaded[file_id] = paths[file_id]
+                else:
+                    failures[file_id] = error
+        finally:
+            pool.close()
+            pool.join()
+        return downloaded, failures
+
+    def download_ranges(self, fd, url, total, chunk_size, progress, 
+            etag=None):
+        """ Downloads url into fd from fd's current position, see 
+        download_to
+
+        Args:
+            etag: When given, Range requests are sent with If-Range so that
+                  Google Drive returns the whole file if it has changed
+
+        Returns:
+            The number of bytes in the downloaded file
+        """
+        offset = fd.tell()
+        with self.transport.connection() as http:
+            while total is None or offset < total:
+                headers = {'Range': 'bytes=%d-%d' % (
+                    offset, offset + chunk_size - 1)}
+                if etag and offset:
+                    headers['If-Range'] = etag
+                if self.metrics is None:
+                    resp, content = self.executor.call(request_range, http,
+                        url, headers)
+                else:
+                    with self.metrics.timer('gdrive_request_seconds', 
+                            endpoint='download'):
+                        resp, content = self.executor.call(request_range, 
+                            http, url, headers)
+                    self.metrics.increment('gdrive_download_bytes_total', 
+                        len(content))
+                if resp.status == 416:
+                    # Requested range starts at the end of the file
+                    break
+                if resp.status not in (200, 206):
+                    # If a 404 or something else was raised, let the user
+                    # know
+                    raise IOError("File could not be found: %s" % resp)
+                if resp.status == 200 and offset:
+                    # The Range header was ignored, or the file changed,
+                    # so start over
+                    fd.seek(0)
+                    fd.truncate()
+                    offset = 0
+                fd.write(content)
+                offset += len(content)
+                if 'content-range' in resp:
+                    # Content-Range: bytes <first>-<last>/<total>
+                    total = int(resp['content-range'].split('/')[-1])
+                if progress:
+                    progress(offset, total)
+                if resp.status == 200 or not content:
+                    # The whole file was returned
+                    break
+        return offset
+
+    def get_file_resource(self, id=None, **kwargs):
+        """ Retrieves the file resource of a single file as a dictionary
+
+            Arguments:
+                id: ID of the file to retrieve
+
+            kwargs:
+                Valid Google Drive queries, used when no id is given
+
+            Raises:
+                ValueError: Multiple files were found, query was not specific
+                            enough
+        """
         if not id:
             # An ID was not specified, so retrieve the file using the query
             file = self.get_file_info(**kwargs)
@@ -303,48 +1369,128 @@ class GDriveAPI(object):
                 raise ValueError("""Multiple files were found, please retry
                     with a more specific query""")
             id = file[0].id
-        # Download the file
-        gdrive_file = self.drive_service.files().get(fileId=id).execute()
-        # Determine if there was a rreturn or if a downloadURL exists
+        return self.execute_cached(('files.get', id),
+            self.drive_service.files().get(fileId=id))
+
+    def execute_cached(self, key, request):
+        """ Executes a request, answering it from the cache when one was
+        given to the GDriveAPI. Cached responses which have expired are
+        revalidated with their ETag, so an unchanged response costs an 
+        empty 304 rather than the full response.
+
+        Args:
+            key: Any JSON serializable value identifying the request
+            request: The apiclient HttpRequest to execute
+
+        Returns:
+            The response of the request
+        """
+        from apiclient import errors
+        if self.cache is None:
+            return self.execute(request)
+        key = json.dumps(key, sort_keys=True, default=str)
+        response, fresh = self.cache.get(key)
+        if self.metrics is not None:
+            self.metrics.increment('gdrive_cache_total', result='hit' 
+                if fresh else 'stale' if response else 'miss')
+        if fresh:
+            return response
+        etag = response.get('etag') if response else None
+        if etag:
+            request.headers['If-None-Match'] = etag
         try:
-            url = gdrive_file['downloadUrl']
-        except KeyError:
-            # Let the user know the file couldn't be found
-            raise IOError("File with id " + str(id) + " could not be found")
-        # Grab contents of the file
-        resp, content = self.drive_service._http.request(url)
-        if resp.status != 200:
-            # If a 404 or something else was raised, let the user know
-            raise IOError("File could not be found: %s" % resp)
-        # Return the content of the file
-        return content
+            response = self.execute(request)
+        except errors.HttpError as error:
+            if etag and error.resp.status == 304:
+                # Not modified, the cached response is still valid
+                self.cache.revalidate(key)
+                return response
+            raise
+        self.cache.put(key, response)
+        return response
 
     def construct_value(self, value):
         """ Constructs a valid value for a query, will join ParseResults
         together so that all words will be apart of the value
 
         Args:
-            value: String, list, or ParseResults of words to be joined
+            value: String, list, or ParseResults of words to be joined, or
+                   a bool
 
         Returns:
-            A value contained in single quotes
+            A value contained in single quotes, with quotes and backslashes 
+            in it escaped, or true or false for a bool
         """
-        query = "'"
-        if type(value) is ParseResults:
-            query += " ".join(value)
-        else:
-            query += value
-        query += "'"
-        return query
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if not isinstance(value, basestring):
+            value = " ".join(value)
+        return "'%s'" % value.replace('\\', '\\\\').replace("'", "\\'")
+
+    def construct_list_query(self, *expressions, **kwargs):
+        """ Constructs the parameters for a files().list request, seperating
+        the files().list parameters (see LIST_PARAMS) from the query fields
+
+        Args:
+            *expressions: Query expressions (see Q) which must also match
+            **kwargs: Query fields and files().list parameters
+
+        Returns:
+            A dictionary of files().list parameters including "q"
+        """
+        params = self.list_params(kwargs)
+        terms = self.construct_terms(And(Q(**kwargs), *expressions))
+        params['q'] = self.render_terms(terms)
+        return params
+
+    def construct_list_queries(self, *expressions, **kwargs):
+        """ Like construct_list_query, but a query longer than
+        max_query_length is split into several queries which together match
+        the same files, see split_terms
+
+        Returns:
+            A list of dictionaries of files().list parameters
+
+        Raises:
+            ValueError: The query is too long and can't be split
+        """
+        params = self.list_params(kwargs)
+        terms = self.construct_terms(And(Q(**kwargs), *expressions))
+        return [dict(params, q=self.render_terms(part)) for part in
+            self.split_terms(terms, self.max_query_length)]
+
+    def list_params(self, kwargs):
+        """ Removes the files().list parameters (see LIST_PARAMS) from
+        kwargs
+
+        Returns:
+            A dictionary of the files().list parameters
+        """
+        params = {}
+        for param in LIST_PARAMS:
+            if param in kwargs:
+                params[param] = kwargs.pop(param)
+        fields = fields_selector(params.pop('fields', self.default_fields),
+            'items')
+        if fields:
+            if 'nextPageToken' not in fields:
+                # Pagination needs the page token even with a partial
+                # response
+                fields = 'nextPageToken,' + fields
+            params['fields'] = fields
+        return params
 
     def construct_query(self, tokens):
         """ Constructs a valid Google Drive SDK query
-        
+
         Some notes:
             If the operator is "in", the query is constructed using the syntax
-            
+
                 <value> in <field>
 
+            and a list of values is constructed as one of these for each
+            value, joined with "or".
+
             If the operator is a contains, =, <, <=, >, >= the query is simply
             constructed using the syntax:
 
@@ -355,27 +1501,214 @@ class GDriveAPI(object):
                     field, value, and operator
 
         Returns:
-            A dictionary with the key "q" containing a valid 
+            A dictionary with the key "q" containing a valid
             Google Drive SDK query.
 
         """
-        query = ""
-        token_length = len(tokens)
-        for token, x in zip(tokens, xrange(token_length)):
-            logging.debug("Constructing query string for token: "
-            + str(token))
-            if token.operator == "in":
-                """ When operator is 'in' query is composed as 
-                    <value> in <field> """
-                query += "%s in %s" % (
-                    self.construct_value(token.value),
-                    token.field)
+        return {"q": self.render_terms(('and',
+            [self.construct_term(token) for token in tokens]))}
+
+    def construct_term(self, token):
+        """ Constructs the query term of a single token, see construct_query
+
+        Returns:
+            A string, or an "or" of strings for a list of values
+        """
+        logging.debug("Constructing query string for token: %s", token)
+        if token.operator == "in":
+            """ When operator is 'in' query is composed as
+                <value> in <field> """
+            if isinstance(token.value, list):
+                return ('or', ["%s in %s" % (self.construct_value(value),
+                    token.field) for value in token.value])
+            return "%s in %s" % (self.construct_value(token.value),
+                token.field)
+        return " ".join([token.field,  token.operator,
+            self.construct_value(token.value)])
+
+    def construct_terms(self, expression):
+        """ Compiles a query expression into a tree of query terms
+
+        Args:
+            expression: A Q, And, Or or Not
+
+        Returns:
+            A query term string, or a tuple of "and" or "or" and a list of
+            terms, or a tuple of "not" and a single term. An "and" of no
+            terms matches every file.
+        """
+        if isinstance(expression, Q):
+            return ('and', [self.construct_term(token) for token in
+                self.parser.parse(**expression.kwargs)])
+        if isinstance(expression, Not):
+            return ('not', self.construct_terms(expression.child))
+        kind = 'and' if isinstance(expression, And) else 'or'
+        terms = []
+        for child in expression.children:
+            term = self.construct_terms(child)
+            if term == ('and', []):
+                if kind == 'or':
+                    # Anything or every file is every file
+                    return term
+                continue
+            if term[0] == kind:
+                # (a and b) and c is a and b and c
+                terms.extend(term[1])
+            elif term[0] != 'not' and len(term[1]) == 1:
+                terms.append(term[1][0])
+            else:
+                terms.append(term)
+        return (kind, terms)
+
+    def render_terms(self, terms, nested=False):
+        """ Renders a tree of query terms (see construct_terms) as a Google
+        Drive SDK query string """
+        if isinstance(terms, basestring):
+            return terms
+        kind, children = terms
+        if kind == 'not':
+            return "not " + self.render_terms(children, True)
+        query = (" %s " % kind).join(self.render_terms(child, True)
+            for child in children)
+        if nested and len(children) > 1:
+            query = "(" + query + ")"
+        return query
+
+    def split_terms(self, terms, max_length):
+        """ Splits a tree of query terms which renders longer than
+        max_length into trees which don't. The files matched by all of the
+        trees together are the files matched by the original one.
+
+        An "or" is split into groups of as many of its alternatives as fit.
+        An "and" is split by splitting its longest "or", repeating the rest
+        of the "and" in every part.
+
+        Returns:
+            A list of trees of query terms
+
+        Raises:
+            ValueError: The terms can't be split to fit, for example a long
+                        "not" or a single long term
+        """
+        if len(self.render_terms(terms)) <= max_length:
+            return [terms]
+        kind = None if isinstance(terms, basestring) else terms[0]
+        if kind == 'or':
+            parts = []
+            group = []
+            for child in terms[1]:
+                for piece in self.split_terms(child, max_length):
+                    if group and len(self.render_terms(
+                            ('or', group + [piece]))) > max_length:
+                        parts.append(('or', group))
+                        group = []
+                    group.append(piece)
+            parts.append(('or', group))
+            return parts
+        if kind == 'and':
+            alternatives = [child for child in terms[1]
+                if not isinstance(child, basestring) and child[0] == 'or']
+            if alternatives:
+                longest = max(alternatives,
+                    key=lambda child: len(self.render_terms(child)))
+                index = terms[1].index(longest)
+                rest = terms[1][:index] + terms[1][index + 1:]
+                # Leave room for the rest, " and " and parentheses
+                budget = max_length - len(self.render_terms(('and', rest),
+                    True)) - 9
+                if budget > 0:
+                    return [('and', rest[:index] + [piece] + rest[index:])
+                        for piece in self.split_terms(longest, budget)]
+        raise ValueError("Query is longer than %d characters and can't be"
+            " split: %s" % (max_length, self.render_terms(terms)))
+
+class AsyncGDriveAPI(object):
+    """ Runs GDriveAPI requests in the background so that many can be in 
+    flight from one process. Every method starts its request on a pool of 
+    worker threads and immediately returns a multiprocessing AsyncResult,
+    whose get() method waits for and returns what the GDriveAPI method of
+    the same name returns. Queries are constructed by the wrapped GDriveAPI.
+
+    The RequestExecutor of the wrapped GDriveAPI still limits how many 
+    requests are sent at the same time, give it a larger max_concurrency to 
+    make use of more workers.
+    """
+
+    def __init__(self, api=None, workers=32, **kwargs):
+        """
+        Args:
+            api: The GDriveAPI to send requests with, by default one is 
+                 created from kwargs
+            workers: Number of requests which can be waited on at the same
+                     time
+            kwargs: Passed to GDriveAPI when api is not given
+        """
+        self.api = api or GDriveAPI(**kwargs)
+        self.pool = ThreadPool(workers)
+
+    def get_folder(self, *expressions, **kwargs):
+        """ See GDriveAPI.get_folder """
+        return self.pool.apply_async(self.api.get_folder, expressions, 
+            kwargs)
+
+    def get_file_info(self, *expressions, **kwargs):
+        """ See GDriveAPI.get_file_info """
+        return self.pool.apply_async(self.api.get_file_info, expressions,
+            kwargs)
+
+    def get_folder_contents(self, folder_id, *expressions, **kwargs):
+        """ See GDriveAPI.get_folder_contents """
+        return self.pool.apply_async(self.api.get_folder_contents, 
+            (folder_id,) + expressions, kwargs)
+
+    def download_file(self, id=None, **kwargs):
+        """ See GDriveAPI.download_file """
+        return self.pool.apply_async(self.api.download_file, (id,), kwargs)
+
+    def iter_files(self, *expressions, **kwargs):
+        """ Like GDriveAPI.iter_files, but the next page is requested in the
+        background while the current page is being iterated over
+
+        Returns:
+            A generator of GDriveFile objects (namedtuples)
+        """
+        queries = self.api.construct_list_queries(*expressions, **kwargs)
+        if len(queries) == 1:
+            return self.iter_query(queries[0])
+        return unique_files(self.iter_query(query) for query in queries)
+
+    def iter_query(self, query):
+        """ Like GDriveAPI.iter_query, prefetching the next page
+
+        Returns:
+            A generator of GDriveFile objects (namedtuples)
+        """
+        query = dict(query)
+        page = self.pool.apply_async(self.api.list_page, (dict(query),))
+        while page is not None:
+            response = page.get()
+            page_token = response.get('nextPageToken')
+            if page_token:
+                query['pageToken'] = page_token
+                page = self.pool.apply_async(self.api.list_page, 
+                    (dict(query),))
             else:
-                query += " ".join([token.field,  token.operator,
-                    self.construct_value(token.value)])
-            if(x+1 < token_length):
-                query += " and "
-        return {"q": query}
+                page = None
+            for gdrive_file in self.api.create_gdrive_files(
+                    response.get('items', [])):
+                yield gdrive_file
+
+    def close(self):
+        """ Waits for the requests already started, then stops the worker 
+        threads """
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 class GDriveAPIParser(object):
 
@@ -401,65 +1734,650 @@ class GDriveAPIParser(object):
             'writers': ['in'],
             'readers': ['in'],
         }
-        fields = Word(" ".join(self.fields_ops.keys()))
-        operators = Word("contains in lte lt gt gte")
-        values = Word(alphanums + " ").leaveWhitespace()
-        self.grammars = {
-            # Defines grammar for queries such as title__contais="[title]"
-            fields("field") + "_" + operators("operator") + "=" + OneOrMore(values)("value"),
-            # Defines grammars for simple equals like, starred=True
-            fields("field") + "=" + values("value")
-        }
+        self.date_fields = ('modifiedDate', 'lastViewedByMeDate')
+        self.boolean_fields = ('trashed', 'starred', 'hidden')
+        self.operators = ('contains', 'in', 'lte', 'lt', 'gt', 'gte')
+        # Memoized (field, operator) splits of previously seen keys
+        self.key_cache = {}
+        self._grammars = None
+
+    @property
+    def grammars(self):
+        """ The pyparsing grammars, built the first time they are needed """
+        if self._grammars is None:
+            from pyparsing import Word, OneOrMore, alphanums
+            fields = Word(" ".join(self.fields_ops.keys()))
+            operators = Word("contains in lte lt gt gte")
+            values = Word(alphanums + " ").leaveWhitespace()
+            self._grammars = {
+                # Defines grammar for queries such as title__contais="[title]"
+                fields("field") + "_" + operators("operator") + "=" + OneOrMore(values)("value"),
+                # Defines grammars for simple equals like, starred=True
+                fields("field") + "=" + values("value")
+            }
+        return self._grammars
     
     def parse(self, **kwargs):
         """ Determines if user's queries are valid
 
+        Well formed keys are split into their field and operator directly,
+        and the split is remembered per key. Anything else falls back to the
+        pyparsing grammars.
+
         Args:
             **kwargs: Dictionary where the keys follow the convention 
-                field__operator
+                field_operator
 
         Returns:
-            A list of pyparsing.ParseResult: Each ParseResult object has the
-                following fields available:
+            A list of tokens (QueryTokens or pyparsing.ParseResults), each
+                token has the following fields available:
                 tokens.field
                 tokens.operator
-                tokens.value
+                tokens.value, a bool for boolean values and a list for
+                    "in" queries given several values
+
+        Raises:
+            ValueError: A query other than an "in" query was given a list of
+                        values
         """
         token_list = []
-        for query,val in kwargs.items():
-            full_query  = query + "="
-            if type(val) is datetime:
-                full_query += val.isoformat()
+        for query, val in kwargs.items():
+            logging.debug("Parsing query: %s=%s", query, val)
+            try:
+                field, operator = self.key_cache[query]
+            except KeyError:
+                field, operator = self.split_key(query)
+                if field is None:
+                    # Not a simple field_operator key, use the grammars
+                    token_list.extend(self.parse_with_grammars(query, val))
+                    continue
+                self.key_cache[query] = (field, operator)
+            words = [field, '=']
+            if operator != '=':
+                words[1:1] = ['_', operator]
+            if isinstance(val, datetime) and field in self.date_fields:
+                # Perform some localization and string conversion
+                value = utc.localize(val).isoformat()
+            elif field in self.boolean_fields and isinstance(val, 
+                    basestring) and val.lower() in ('true', 'false'):
+                value = val.lower() == 'true'
+            elif isinstance(val, (bool, basestring)):
+                value = val
+            elif isinstance(val, (list, tuple, set)):
+                if operator != 'in':
+                    raise ValueError("Query " + query + " must be given a "
+                        "single value, not " + repr(val))
+                # Any of several values
+                value = list(val)
             else:
-                full_query += val
-            logging.debug("Parsing query: " + full_query)
-            # Try each of the grammars
-            for grammar in self.grammars:
-                try:
-                    # Use only correct parses
-                    tokens = grammar.parseString(full_query)
-                    # Determine if this is a valid operator for this field
-                    if not tokens.operator:
-                        # Operator is an equal sign =
-                        tokens.operator = '='
-                    # Determine if the operator is valid
-                    if not tokens.operator in self.fields_ops[tokens.field]:
-                        raise ValueError("Field " + tokens.field 
-                            + " does not have operator " + tokens.operator)
-                    # If the passed in field was a date field
-                    if('modifiedDate' == tokens.field or 
-                        'lastViewedByMeDate' == tokens.field):
-                        logging.debug("Performing date localizations")
-                        # Replace operator word with actual operator
-                        tokens.operator = self.op_map[tokens.operator] 
-                        # Perform some localization and string conversion
-                        localized_date = utc.localize(val)
-                        # Replace current value with the UTC string value
-                        tokens.value = localized_date.isoformat()
-                    token_list.append(tokens)
-                except ParseException:
-                    # Ignore incorrect parsers
-                    logging.debug("query " + full_query + " did not pass "
-                    + "grammar " + str(grammar))
-                    pass
+                value = str(val)
+            if isinstance(value, bool):
+                words.append(str(value).lower())
+            elif isinstance(value, list):
+                words.append(", ".join(value))
+            else:
+                words.append(value)
+            if field in self.date_fields:
+                # Replace operator word with actual operator
+                operator = self.op_map[operator]
+            token_list.append(QueryToken(field, operator, value, words))
         return token_list 
+
+    def split_key(self, query):
+        """ Splits a field_operator key into its field and operator
+
+        Returns:
+            A tuple of the field and operator, or (None, None) if the key is
+            not made of a known field and operator
+
+        Raises:
+            ValueError: The operator is not valid for the field
+        """
+        if query in self.fields_ops:
+            field, operator = query, '='
+        else:
+            field, _, operator = query.rpartition('_')
+            if field not in self.fields_ops or operator not in self.operators:
+                return None, None
+        # Determine if the operator is valid
+        if not operator in self.fields_ops[field]:
+            raise ValueError("Field " + field 
+                + " does not have operator " + operator)
+        return field, operator
+
+    def parse_with_grammars(self, query, val):
+        """ Parses a single query using the pyparsing grammars
+
+        Returns:
+            A list of pyparsing.ParseResult
+        """
+        from pyparsing import ParseException
+        token_list = []
+        full_query  = query + "="
+        if type(val) is datetime:
+            full_query += val.isoformat()
+        else:
+            full_query += val
+        # Try each of the grammars
+        for grammar in self.grammars:
+            try:
+                # Use only correct parses
+                tokens = grammar.parseString(full_query)
+                # Determine if this is a valid operator for this field
+                if not tokens.operator:
+                    # Operator is an equal sign =
+                    tokens.operator = '='
+                # Determine if the operator is valid
+                if not tokens.operator in self.fields_ops[tokens.field]:
+                    raise ValueError("Field " + tokens.field 
+                        + " does not have operator " + tokens.operator)
+                # If the passed in field was a date field
+                if tokens.field in self.date_fields:
+                    logging.debug("Performing date localizations")
+                    # Replace operator word with actual operator
+                    tokens.operator = self.op_map[tokens.operator] 
+                    # Perform some localization and string conversion
+                    localized_date = utc.localize(val)
+                    # Replace current value with the UTC string value
+                    tokens.value = localized_date.isoformat()
+                token_list.append(tokens)
+            except ParseException:
+                # Ignore incorrect parsers
+                logging.debug("query %s did not pass grammar %s", 
+                    full_query, grammar)
+        return token_list
+
+
+class QueryToken(object):
+    """ A parsed query, the fast path equivalent of the ParseResults 
+    produced by the GDriveAPIParser grammars. Iterating over a QueryToken
+    yields the same words as iterating over the ParseResults would. """
+
+    __slots__ = ('field', 'operator', 'value', 'words')
+
+    def __init__(self, field, operator, value, words):
+        self.field = field
+        self.operator = operator
+        self.value = value
+        self.words = words
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __repr__(self):
+        return "QueryToken(%r)" % (self.words,)
+
+
+class QueryExpression(object):
+    """ Base of query expressions, which are combined with & (and),
+    | (or) and ~ (not) and passed to GDriveAPI.get_file_info """
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+
+class Q(QueryExpression):
+    """ Query fields given as keyword arguments, in the form accepted by
+    GDriveAPI.get_file_info, which must all match """
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return "Q(%s)" % ", ".join("%s=%r" % item
+            for item in sorted(self.kwargs.items()))
+
+
+class And(QueryExpression):
+    """ Matches files matched by every one of its expressions """
+
+    def __init__(self, *children):
+        self.children = children
+
+    def __repr__(self):
+        return "And%r" % (self.children,)
+
+
+class Or(QueryExpression):
+    """ Matches files matched by any of its expressions """
+
+    def __init__(self, *children):
+        self.children = children
+
+    def __repr__(self):
+        return "Or%r" % (self.children,)
+
+
+class Not(QueryExpression):
+    """ Matches files not matched by its expression """
+
+    def __init__(self, child):
+        self.child = child
+
+    def __repr__(self):
+        return "Not(%r)" % (self.child,)
+
+
+class SortKey(object):
+    """ Orders values in ascending or descending order, for sorting values
+    which can't be negated such as dates """
+
+    __slots__ = ('value', 'descending')
+
+    def __init__(self, value, descending=False):
+        self.value = value
+        self.descending = descending
+
+    def __lt__(self, other):
+        if self.descending:
+            return other.value < self.value
+        return self.value < other.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+
+def unique_files(iterators):
+    """ Chains iterators of GDriveFiles, leaving out files already returned
+    by an earlier iterator """
+    seen = set()
+    for iterator in iterators:
+        for gdrive_file in iterator:
+            if gdrive_file.id not in seen:
+                seen.add(gdrive_file.id)
+                yield gdrive_file
+
+class ResponseCache(object):
+    """ A thread safe cache of Google Drive responses. Responses expire
+    after ttl seconds and the least recently used responses are evicted once
+    more than max_size are held. Expired responses are kept until evicted so
+    that they can be revalidated with their ETag.
+
+    hits, misses, revalidations and evictions count how the cache has been
+    used, which is useful for choosing max_size and ttl.
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Looks up a response
+
+        Returns:
+            A tuple of the cached response, or None, and whether the
+            response is still fresh
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            # Move the entry to the most recently used end
+            self.entries[key] = entry
+            expires, response = entry
+            if expires > time.time():
+                self.hits += 1
+                return response, True
+            self.misses += 1
+            return response, False
+
+    def put(self, key, response):
+        """ Stores a response """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, response)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def revalidate(self, key):
+        """ Marks a response as fresh again after Google Drive confirmed it
+        has not changed """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries[key] = (time.time() + self.ttl, entry[1])
+            self.revalidations += 1
+
+    def invalidate(self, key=None):
+        """ Removes one response, or every response if no key is given """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        """ Returns the cache counters as a dictionary """
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "evictions": self.evictions,
+            }
+
+
+class ThreadLocalTransport(object):
+    """ Gives every thread its own authorized httplib2.Http, since httplib2
+    is not thread safe. Each Http keeps its connections to Google Drive
+    alive between requests. The credentials are shared by every Http,
+    oauth2client serializes token refreshes through the credentials' 
+    Storage lock.
+    """
+
+    def __init__(self, credentials, http_factory=httplib2.Http):
+        self.credentials = credentials
+        self.http_factory = http_factory
+        self.local = threading.local()
+
+    @contextmanager
+    def connection(self):
+        """ Yields the authorized Http object of the calling thread """
+        http = getattr(self.local, 'http', None)
+        if http is None:
+            http = self.credentials.authorize(self.http_factory())
+            self.local.http = http
+        yield http
+
+
+class PooledTransport(object):
+    """ Shares a bounded pool of authorized httplib2.Http objects between
+    any number of threads. A thread borrows an Http for the length of a
+    request and waits when all size of them are in use. Useful when many
+    short lived threads make requests.
+
+    Pass a size with functools.partial, for example
+
+        GDriveAPI(path, transport=partial(PooledTransport, size=16))
+    """
+
+    def __init__(self, credentials, size=10, http_factory=httplib2.Http):
+        self.credentials = credentials
+        self.http_factory = http_factory
+        self.size = size
+        self.created = 0
+        self.pool = Queue.Queue()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """ Yields an authorized Http object borrowed from the pool """
+        try:
+            http = self.pool.get_nowait()
+        except Queue.Empty:
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if create:
+                http = self.credentials.authorize(self.http_factory())
+            else:
+                http = self.pool.get()
+        try:
+            yield http
+        finally:
+            self.pool.put(http)
+
+
+class ByteBudget(object):
+    """ Limits the number of bytes being worked on at the same time across
+    threads """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, size):
+        """ Waits until size bytes are free and holds on to them until the
+        block finishes. A size larger than the limit waits until nothing 
+        else is in use. """
+        with self.condition:
+            while self.in_use and self.in_use + size > self.limit:
+                self.condition.wait()
+            self.in_use += size
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_use -= size
+                self.condition.notify_all()
+
+class RequestExecutor(object):
+    """ Sends requests to Google Drive at a sustainable pace. Requests are
+    rate limited with a token bucket, rate limited and failed requests are
+    retried with exponential backoff and jitter, and the number of requests
+    in flight is adjusted AIMD style: it grows by one per window of 
+    successful requests and halves whenever Google Drive reports that a 
+    quota has been exceeded.
+
+    Args:
+        rate: Number of requests allowed per second on average
+        burst: Number of requests which can be sent at once after a lull
+        max_retries: Number of times a request is retried before its error
+                     is raised
+        max_concurrency: Upper bound of requests in flight
+        backoff_base: Seconds waited before the first retry, doubled for
+                      every following retry
+        max_backoff: Upper bound of the seconds waited before a retry
+        metrics: An optional metrics sink which is told about every retry
+    """
+
+    def __init__(self, rate=10.0, burst=20, max_retries=6, 
+            max_concurrency=16, backoff_base=1.0, max_backoff=64.0,
+            metrics=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.max_concurrency = max_concurrency
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.retries = 0
+        self.metrics = metrics
+        self.condition = threading.Condition()
+
+    def call(self, function, *args, **kwargs):
+        """ Calls function, which sends a request, retrying it when it fails
+        with a rate limit, server or connection error
+
+        Returns:
+            Whatever function returns
+        """
+        from apiclient import errors
+        for attempt in xrange(self.max_retries + 1):
+            self.acquire()
+            try:
+                result = function(*args, **kwargs)
+            except errors.HttpError as error:
+                if not is_retryable(error) or attempt == self.max_retries:
+                    raise
+                if error.resp.status in (403, 429):
+                    self.throttled()
+            except (socket.error, httplib2.HttpLib2Error):
+                if attempt == self.max_retries:
+                    raise
+            else:
+                self.succeeded()
+                return result
+            finally:
+                self.release()
+            delay = self.backoff(attempt)
+            logging.debug("Retrying request in %.2f seconds", delay)
+            with self.condition:
+                self.retries += 1
+            if self.metrics is not None:
+                self.metrics.increment('gdrive_retries_total')
+            time.sleep(delay)
+
+    def acquire(self):
+        """ Waits for a token and for a free request slot """
+        with self.condition:
+            while True:
+                now = time.time()
+                # Ignore the clock going backwards
+                elapsed = max(0, now - self.updated)
+                self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+                self.updated = now
+                if self.in_flight < int(self.concurrency) and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                if self.tokens < 1:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.condition.wait()
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def succeeded(self):
+        """ Additive increase, one more request in flight per window """
+        with self.condition:
+            self.concurrency = min(self.max_concurrency, 
+                self.concurrency + 1.0 / self.concurrency)
+            self.condition.notify()
+
+    def throttled(self):
+        """ Multiplicative decrease after a quota error """
+        with self.condition:
+            self.concurrency = max(1.0, self.concurrency / 2)
+            logging.debug("Throttled, concurrency is now %d", 
+                self.concurrency)
+
+    def backoff(self, attempt):
+        """ Returns the seconds to wait before retry number attempt, chosen
+        at random up to an exponentially growing bound ("full jitter") """
+        return random.uniform(0, min(self.max_backoff, 
+            self.backoff_base * 2 ** attempt))
+
+
+# Upper bounds, in seconds, of the buckets latencies are counted in
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0, 30.0, 60.0)
+
+class InMemoryMetrics(object):
+    """ A metrics sink which keeps counters and histograms in memory, to be
+    exported in the Prometheus text format or as JSON. 
+
+    Any object with the increment, observe and timer methods can be used
+    as a metrics sink by GDriveAPI, RequestExecutor and GDriveBackup.
+
+    Args:
+        buckets: Upper bounds of the buckets observed values are counted in
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # Keyed by (name, sorted label items)
+        self.counters = {}
+        # Keyed like counters, a list of the number of values in each 
+        # bucket, the last one unbounded, followed by the sum of the values
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        """ Adds value to a counter """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ Counts value in a histogram """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = [0] * (len(self.buckets) + 2)
+                self.histograms[key] = histogram
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Observes the number of seconds the block takes """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def snapshot(self):
+        """ Returns every counter and histogram as a dictionary """
+        with self.lock:
+            counters = self.counters.items()
+            histograms = [(key, list(histogram)) 
+                for key, histogram in self.histograms.items()]
+        snapshot = {'counters': [], 'histograms': []}
+        for (name, labels), value in sorted(counters):
+            snapshot['counters'].append({'name': name, 
+                'labels': dict(labels), 'value': value})
+        for (name, labels), histogram in sorted(histograms):
+            counts = histogram[:-1]
+            cumulative = [sum(counts[:x + 1]) for x in xrange(len(counts))]
+            snapshot['histograms'].append({'name': name, 
+                'labels': dict(labels), 
+                'buckets': zip(self.buckets + ('+Inf',), cumulative),
+                'sum': histogram[-1], 'count': cumulative[-1]})
+        return snapshot
+
+    def json(self):
+        """ Returns every counter and histogram as a JSON document """
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def prometheus_text(self):
+        """ Returns every counter and histogram in the Prometheus text 
+        exposition format """
+        def series(name, labels, value, **extra):
+            labels = dict(labels, **extra)
+            if labels:
+                name += '{%s}' % ','.join('%s="%s"' % (key, 
+                    str(label).replace('\\', '\\\\').replace('"', '\\"'))
+                    for key, label in sorted(labels.items()))
+            return '%s %s' % (name, value)
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for counter in snapshot['counters']:
+            if counter['name'] not in typed:
+                typed.add(counter['name'])
+                lines.append('# TYPE %s counter' % counter['name'])
+            lines.append(series(counter['name'], counter['labels'], 
+                counter['value']))
+        for histogram in snapshot['histograms']:
+            name = histogram['name']
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            for bound, count in histogram['buckets']:
+                lines.append(series(name + '_bucket', histogram['labels'], 
+                    count, le=bound))
+            lines.append(series(name + '_sum', histogram['labels'], 
+                histogram['sum']))
+            lines.append(series(name + '_count', histogram['labels'], 
+                histogram['count']))
+        return '\n'.join(lines) + '\n'
@@ -1,7 +1,277 @@
+import dataset
+import gdriveapi
+import hashlib
+import httplib2
+import imp
+import json
+import mock
+import os
+import re
+import urllib
+import urllib2
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from gdriveapi import AsyncGDriveAPI
+from gdriveapi import ByteBudget
 from gdriveapi import GDriveAPI
 from gdriveapi import GDriveAPIParser
+from gdriveapi import InMemoryMetrics
+from gdriveapi import ResponseCache
+from gdriveapi import load_discovery_document
+from gdriveapi import MINIMAL_FIELDS
+from gdriveapi import PooledTransport
+from gdriveapi import Q
+from gdriveapi import RequestExecutor
+from multiprocessing.pool import ThreadPool
 from datetime import datetime, timedelta
+from apiclient.discovery import build_from_document
+from apiclient.errors import HttpError
+from apiclient.http import HttpMockSequence
+
+gdrive_backup = imp.load_source('gdrive_backup', 
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+        'gdrive-backup.py'))
+
+# A trimmed down Drive v2 discovery document, enough to build a service that
+# talks to a local HttpMockSequence instead of Google Drive
+DRIVE_DISCOVERY = {
+    "kind": "discovery#restDescription",
+    "discoveryVersion": "v1",
+    "id": "drive:v2",
+    "name": "drive",
+    "version": "v2",
+    "rootUrl": "https://www.googleapis.com/",
+    "servicePath": "drive/v2/",
+    "baseUrl": "https://www.googleapis.com/drive/v2/",
+    "batchPath": "batch",
+    "parameters": {
+        "fields": {"type": "string", "location": "query"},
+    },
+    "schemas": {
+        "File": {"id": "File", "type": "object"},
+        "FileList": {"id": "FileList", "type": "object"},
+        "About": {"id": "About", "type": "object"},
+        "ChangeList": {"id": "ChangeList", "type": "object"},
+        "Channel": {"id": "Channel", "type": "object"},
+    },
+    "resources": {
+        "about": {
+            "methods": {
+                "get": {
+                    "id": "drive.about.get",
+                    "path": "about",
+                    "httpMethod": "GET",
+                    "response": {"$ref": "About"},
+                },
+            },
+        },
+        "changes": {
+            "methods": {
+                "list": {
+                    "id": "drive.changes.list",
+                    "path": "changes",
+                    "httpMethod": "GET",
+                    "parameters": {
+                        "startChangeId": {"type": "string",
+                            "location": "query"},
+                        "includeDeleted": {"type": "boolean",
+                            "location": "query"},
+                        "pageToken": {"type": "string", "location": "query"},
+                    },
+                    "response": {"$ref": "ChangeList"},
+                },
+                "watch": {
+                    "id": "drive.changes.watch",
+                    "path": "changes/watch",
+                    "httpMethod": "POST",
+                    "request": {"$ref": "Channel"},
+                    "response": {"$ref": "Channel"},
+                },
+            },
+        },
+        "channels": {
+            "methods": {
+                "stop": {
+                    "id": "drive.channels.stop",
+                    "path": "channels/stop",
+                    "httpMethod": "POST",
+                    "request": {"$ref": "Channel"},
+                },
+            },
+        },
+        "files": {
+            "methods": {
+                "list": {
+                    "id": "drive.files.list",
+                    "path": "files",
+                    "httpMethod": "GET",
+                    "parameters": {
+                        "q": {"type": "string", "location": "query"},
+                        "pageToken": {"type": "string", "location": "query"},
+                        "maxResults": {"type": "integer",
+                            "location": "query"},
+                        "orderBy": {"type": "string", "location": "query"},
+                    },
+                    "response": {"$ref": "FileList"},
+                },
+                "get": {
+                    "id": "drive.files.get",
+                    "path": "files/{fileId}",
+                    "httpMethod": "GET",
+                    "parameters": {
+                        "fileId": {"type": "string", "location": "path",
+                            "required": True},
+                    },
+                    "parameterOrder": ["fileId"],
+                    "response": {"$ref": "File"},
+                },
+                "insert": {
+                    "id": "drive.files.insert",
+                    "path": "files",
+                    "httpMethod": "POST",
+                    "parameters": {
+                        "convert": {"type": "boolean", "location": "query"},
+                    },
+                    "request": {"$ref": "File"},
+                    "response": {"$ref": "File"},
+                    "supportsMediaUpload": True,
+                    "mediaUpload": {
+                        "accept": ["*/*"],
+                        "protocols": {
+                            "simple": {"multipart": True,
+                                "path": "/upload/drive/v2/files"},
+                            "resumable": {"multipart": True,
+                                "path": "/resumable/upload/drive/v2/files"},
+                        },
+                    },
+                },
+            },
+        },
+    },
+}
+
+
+def batch_response(parts):
+    """ Builds a multipart batch response out of (request id, status, body)
+    tuples """
+    body = ""
+    for request_id, status, content in parts:
+        body += ("--batch_boundary\r\n"
+            "Content-Type: application/http\r\n"
+            "Content-ID: <response-batch + %s>\r\n\r\n"
+            "HTTP/1.1 %d OK\r\n"
+            "Content-Type: application/json\r\n\r\n"
+            "%s\r\n") % (request_id, status, json.dumps(content))
+    body += "--batch_boundary--"
+    return ({'status': '200',
+        'content-type': 'multipart/mixed; boundary="batch_boundary"'}, body)
+
+
+# The folder fake_backup backs up, as listed by the PathResolver
+BACKUP_FOLDER = {'id': 'folder', 'title': 'Backup', 
+    'parents': [{'id': 'root'}]}
+
+
+def notify(server, channel_id, token, state):
+    """ Posts a Google Drive push notification to a NotificationServer """
+    urllib2.urlopen(urllib2.Request("http://127.0.0.1:%d/" % 
+        server.server_address[1], "", {
+            'X-Goog-Channel-ID': channel_id,
+            'X-Goog-Channel-Token': token,
+            'X-Goog-Resource-State': state,
+        })).read()
+
+
+def wait_for(condition, timeout=5):
+    """ Waits for condition() to be true """
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def mock_http(responses):
+    """ Builds an HttpMockSequence out of (headers, body) responses, bodies 
+    which aren't strings are encoded as JSON """
+    return HttpMockSequence([(headers, body if isinstance(body, str)
+        else json.dumps(body)) for headers, body in responses])
+
+
+class FolderTreeHttp(object):
+    """ A thread safe stand in for Google Drive which answers 
+    "'<id>' in parents" queries from a dictionary of folder ids to their 
+    children """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.listed = []
+        self.queries = []
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        query = urllib.unquote_plus(uri)
+        folder_id = re.search(r"'(\w+)' in parents", query).group(1)
+        self.listed.append(folder_id)
+        self.queries.append(query)
+        return (httplib2.Response({'status': '200'}), 
+            json.dumps({'items': self.tree.get(folder_id, [])}))
+
+
+def patch_drive(http):
+    """ Patches gdriveapi so that GDriveAPI talks to http instead of Google
+    Drive """
+    storage = mock.patch('oauth2client.file.Storage')
+    build = mock.patch('gdriveapi.build_drive_service', 
+        return_value=build_from_document(DRIVE_DISCOVERY, http=http))
+    credentials = storage.start().return_value.get.return_value
+    credentials.authorize.return_value = http
+    build.start()
+    return [storage, build]
+
+
+def fake_gdrive(responses, **kwargs):
+    """ Builds a GDriveAPI backed by an HttpMockSequence of
+    (headers, body) responses rather than Google Drive """
+    http = mock_http(responses)
+    patches = patch_drive(http)
+    try:
+        gdrive = GDriveAPI("fake_credentials", **kwargs)
+    finally:
+        for patch in patches:
+            patch.stop()
+    return gdrive, http
+
+
+def fake_backup(responses, tempdir):
+    """ Builds a GDriveBackup backed by an HttpMockSequence and an in 
+    memory database, backing up the folder "Backup" into tempdir """
+    config_path = os.path.join(tempdir, 'config.json')
+    with open(config_path, 'w') as config_file:
+        json.dump({
+            "client_id": "id",
+            "client_secret": "secret",
+            "paths": [{
+                "gdrive_path": "Backup",
+                "filesystem_path": os.path.join(tempdir, "Backup"),
+            }],
+            "store_path": os.path.join(tempdir, "store"),
+        }, config_file)
+    http = mock_http(responses)
+    patches = patch_drive(http) + [
+        mock.patch.object(gdrive_backup, 'Storage'),
+        mock.patch.object(gdrive_backup.dataset, 'connect',
+            return_value=dataset.connect('sqlite://')),
+    ]
+    for patch in patches[2:]:
+        patch.start()
+    try:
+        backup = gdrive_backup.GDriveBackup(config_path)
+    finally:
+        for patch in patches:
+            patch.stop()
+    return backup, http
+
 
 class GDriveAPITests(unittest.TestCase):
     """ Tests GDriveAPI  for several cases including:
@@ -39,6 +309,37 @@ class GDriveAPITests(unittest.TestCase):
         for expected, result in zip(token_list, tokens[0]):
             self.assertEqual(expected, result, expected + "!=" + result)
 
+    def test_parse_keeps_punctuation(self):
+        parser = GDriveAPIParser()
+        tokens = parser.parse(mimeType="application/vnd.google-apps.folder")
+        self.assertEqual(tokens[0].field, 'mimeType')
+        self.assertEqual(tokens[0].operator, '=')
+        self.assertEqual(tokens[0].value, 'application/vnd.google-apps.folder')
+
+    def test_parse_booleans(self):
+        gdrive = GDriveAPI.__new__(GDriveAPI)
+        gdrive.parser = GDriveAPIParser()
+        gdrive.default_fields = None
+        for value in (False, 'false', 'False'):
+            self.assertEqual(gdrive.construct_list_query(trashed=value),
+                {'q': 'trashed = false'})
+        self.assertEqual(gdrive.construct_list_query(starred=True),
+            {'q': 'starred = true'})
+        self.assertEqual(gdrive.construct_list_query(title='false'),
+            {'q': "title = 'false'"})
+
+    def test_parse_rejects_lists(self):
+        parser = GDriveAPIParser()
+        self.assertRaises(ValueError, parser.parse, title=['a', 'b'])
+        self.assertEqual(parser.parse(parents_in=('a', 'b'))[0].value, 
+            ['a', 'b'])
+
+    def test_parse_dates(self):
+        parser = GDriveAPIParser()
+        tokens = parser.parse(modifiedDate_gte=datetime(2013, 10, 1))
+        self.assertEqual(tokens[0].operator, '>=')
+        self.assertEqual(tokens[0].value, '2013-10-01T00:00:00+00:00')
+
     def test_fulltext_equals(self):
         """ This test should fail since fullText cannot use the = operator """
         parser = GDriveAPIParser()
@@ -95,5 +396,1014 @@ class GDriveAPITests(unittest.TestCase):
                 "A test file", "text/Plain")
 
 
+class GDriveAPIOfflineTests(unittest.TestCase):
+    """ Tests GDriveAPI against a local fake of Google Drive """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_iter_files_follows_page_token(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '200'}, {'items': [{'id': '1'}, {'id': '2'}],
+                'nextPageToken': 'page2'}),
+            ({'status': '200'}, {'items': [{'id': '3'}]}),
+        ])
+        files = gdrive.iter_files(title="blue", maxResults=2)
+        self.assertEqual(files.next().id, '1')
+        # Only the first page has been requested so far
+        self.assertEqual(len(http._iterable), 1)
+        self.assertEqual([f.id for f in files], ['2', '3'])
+        self.assertEqual(len(http._iterable), 0)
+
+    def test_query_expressions(self):
+        gdrive, http = fake_gdrive([])
+        query = gdrive.construct_list_query(
+            Q(title_contains="blue") | ~Q(starred=True), 
+            parents_in=['a', 'b'], trashed=False)
+        self.assertEqual(query['q'], "('a' in parents or 'b' in parents) "
+            "and trashed = false and (title contains 'blue' or "
+            "not starred = true)")
+        self.assertEqual(gdrive.construct_list_query(title="It's a\\b"),
+            {'q': "title = 'It\\'s a\\\\b'"})
+        self.assertEqual(gdrive.construct_list_query(~(Q(title="a") &
+            Q(title_contains="b")))['q'], 
+            "not (title = 'a' and title contains 'b')")
+
+    def test_long_queries_are_split(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '200'}, {'items': [{'id': '1'}, {'id': '2'}]}),
+            ({'status': '200'}, {'items': [{'id': '2'}, {'id': '3'}]}),
+        ])
+        gdrive.max_query_length = 100
+        folders = ['folder%d' % x for x in xrange(6)]
+        queries = gdrive.construct_list_queries(parents_in=folders, 
+            trashed=False)
+        self.assertEqual(len(queries), 2)
+        for query in queries:
+            self.assertTrue(len(query['q']) <= 100)
+            self.assertTrue(query['q'].endswith(" and trashed = false"))
+        self.assertEqual(" or ".join(query['q'].split(" and ")[0][1:-1] 
+            for query in queries), " or ".join(
+                "'%s' in parents" % folder for folder in folders))
+        files = gdrive.get_folder_contents(folders, trashed=False)
+        # Files in folders from both requests are only returned once
+        self.assertEqual([f.id for f in files], ['1', '2', '3'])
+        self.assertEqual(len(http._iterable), 0)
+        self.assertRaises(ValueError, gdrive.construct_list_queries,
+            ~Q(parents_in=folders))
+
+    def test_query_many_merges_listings(self):
+        def text(id, date):
+            return {'id': id, 'title': id, 'mimeType': 'text/plain',
+                'modifiedDate': '2013-10-%02dT00:00:00.000Z' % date}
+        class SlowTreeHttp(FolderTreeHttp):
+            def request(self, *args, **kwargs):
+                time.sleep(0.2)
+                return FolderTreeHttp.request(self, *args, **kwargs)
+        http = SlowTreeHttp({
+            'f1': [text('a', 5), text('b', 3), text('c', 1)],
+            'f2': [text('d', 6), text('b', 3), text('e', 2)],
+            'f3': [text('f', 4)],
+            'f4': [],
+        })
+        gdrive, _ = fake_gdrive([])
+        gdrive.credentials.authorize.return_value = http
+        queries = [{'parents_in': folder} for folder in sorted(http.tree)]
+        started = time.time()
+        files = gdrive.query_many(queries, workers=4, 
+            order_by="modifiedDate desc")
+        self.assertEqual([f.id for f in files], 
+            ['d', 'a', 'f', 'b', 'e', 'c'])
+        # The listings were requested at the same time
+        self.assertTrue(time.time() - started < 0.6)
+        for query in http.queries:
+            self.assertIn('orderBy=modifiedDate desc', query)
+        files = gdrive.query_many(queries, workers=2)
+        self.assertEqual(sorted(f.id for f in files), 
+            ['a', 'b', 'c', 'd', 'e', 'f'])
+        # FolderTreeHttp fails queries without a parent, the error of a
+        # listing is raised by the generator
+        files = gdrive.query_many(queries + [{'title': 'no parents'}])
+        self.assertRaises(AttributeError, list, files)
+
+    def test_async_iter_files_prefetches_next_page(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '200'}, {'items': [{'id': '1'}],
+                'nextPageToken': 'page2'}),
+            ({'status': '200'}, {'items': [{'id': '2'}]}),
+        ])
+        with AsyncGDriveAPI(gdrive, workers=2) as async_gdrive:
+            files = async_gdrive.iter_files(title="blue")
+            self.assertEqual(files.next().id, '1')
+            # The second page was requested before it was iterated over
+            for x in xrange(100):
+                if not http._iterable:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(len(http._iterable), 0)
+            self.assertEqual([f.id for f in files], ['2'])
+
+    def test_async_requests_are_in_flight_together(self):
+        gdrive, http = fake_gdrive([])
+        lock = threading.Lock()
+        all_started = threading.Event()
+        started = []
+        def request(uri, method='GET', body=None, headers=None, **kwargs):
+            with lock:
+                started.append(uri)
+                if len(started) == 3:
+                    all_started.set()
+            # Answer only once every request has been sent
+            all_started.wait(5)
+            return (httplib2.Response({'status': '200'}), 
+                json.dumps({'items': [{'id': 'file'}]}))
+        http.request = request
+        with AsyncGDriveAPI(gdrive, workers=3) as async_gdrive:
+            results = [async_gdrive.get_folder_contents(folder_id) 
+                for folder_id in ('a', 'b', 'c')]
+            contents = [result.get(5) for result in results]
+        self.assertTrue(all_started.is_set())
+        self.assertEqual([[f.id for f in files] for files in contents],
+            [['file']] * 3)
+
+    def test_metrics_record_requests(self):
+        metrics = InMemoryMetrics()
+        gdrive, http = fake_gdrive([
+            ({'status': '503'}, ''),
+            ({'status': '200'}, {'items': [{'id': '1'}],
+                'nextPageToken': 'page2'}),
+            ({'status': '200'}, {'items': [{'id': '2'}]}),
+            ({'status': '200'}, {'id': '2', 'fileSize': '4',
+                'downloadUrl': 'https://example.com/2'}),
+            ({'status': '206', 'content-range': 'bytes 0-3/4'}, 'data'),
+        ], metrics=metrics, executor=RequestExecutor(backoff_base=0))
+        self.assertEqual(len(gdrive.get_file_info(title="blue")), 2)
+        self.assertEqual(gdrive.download_file('2'), 'data')
+        counters = dict(((counter['name'], counter['labels'].get('endpoint')),
+            counter['value']) for counter in metrics.snapshot()['counters'])
+        self.assertEqual(counters[('gdrive_pages_total', None)], 2)
+        self.assertEqual(counters[('gdrive_retries_total', None)], 1)
+        self.assertEqual(counters[('gdrive_download_bytes_total', None)], 4)
+        self.assertEqual(counters[('gdrive_response_bytes_total',
+            'drive.files.list')], len(json.dumps({'items': [{'id': '1'}],
+                'nextPageToken': 'page2'})) + len(json.dumps(
+                    {'items': [{'id': '2'}]})))
+        text = metrics.prometheus_text()
+        self.assertIn('# TYPE gdrive_request_seconds histogram\n', text)
+        self.assertIn('gdrive_request_seconds_count'
+            '{endpoint="drive.files.list"} 2\n', text)
+        self.assertIn('gdrive_request_seconds_bucket{endpoint="download",'
+            'le="+Inf"} 1\n', text)
+        self.assertEqual(json.loads(metrics.json()), 
+            json.loads(json.dumps(metrics.snapshot())))
+
+    def test_get_file_info_returns_every_page(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '200'}, {'items': [{'id': '1'}],
+                'nextPageToken': 'page2'}),
+            ({'status': '200'}, {'items': [{'id': '2'}]}),
+        ])
+        files = gdrive.get_file_info(title="blue")
+        self.assertEqual([f.id for f in files], ['1', '2'])
+
+    def test_fields_keeps_page_token(self):
+        gdrive, http = fake_gdrive([])
+        query = gdrive.construct_list_query(title="blue",
+            fields="items(id,title)")
+        self.assertEqual(query['fields'], "nextPageToken,items(id,title)")
+        self.assertEqual(query['q'], "title = 'blue'")
+
+    def test_fields_list_and_default_projection(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '200'}, {'items': [{'id': '1', 'title': 'a', 
+                'mimeType': 'text/plain'}]}),
+        ], default_fields=MINIMAL_FIELDS)
+        self.assertEqual(gdrive.construct_list_query(title="blue")['fields'],
+            "nextPageToken,items(id,title,mimeType)")
+        self.assertEqual(gdrive.construct_list_query(title="blue",
+            fields=['id', 'parents(id)'])['fields'],
+            "nextPageToken,items(id,parents(id))")
+        with mock.patch.object(http, 'request', 
+                wraps=http.request) as request:
+            files = gdrive.get_file_info(title="blue")
+        uri = urllib.unquote(request.call_args[0][0])
+        self.assertIn('fields=nextPageToken,items(id,title,mimeType)', uri)
+        self.assertEqual(type(files[0])._fields, ('id', 'mimeType', 'title'))
+
+    def test_cache_answers_repeated_queries(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '200'}, {'items': [{'id': '1'}], 'etag': '"v1"'}),
+            ({'status': '304'}, ''),
+        ])
+        gdrive.cache = ResponseCache(ttl=60)
+        with mock.patch('gdriveapi.time.time', return_value=1000):
+            self.assertEqual(gdrive.get_folder(title="a")[0].id, '1')
+            self.assertEqual(gdrive.get_folder(title="a")[0].id, '1')
+        # Expired responses are revalidated with their ETag
+        with mock.patch('gdriveapi.time.time', return_value=2000):
+            self.assertEqual(gdrive.get_folder(title="a")[0].id, '1')
+        self.assertEqual(len(http._iterable), 0)
+        stats = gdrive.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], 
+            stats['revalidations']), (1, 2, 1))
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = ResponseCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), (None, False))
+        self.assertEqual(cache.get('a'), (1, True))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        cache.invalidate()
+        self.assertEqual(cache.get('c'), (None, False))
+
+    def test_pooled_transport_bounds_connections(self):
+        credentials = mock.Mock()
+        credentials.authorize.side_effect = lambda http: http
+        transport = PooledTransport(credentials, size=2, 
+            http_factory=object)
+        in_use = set()
+        def borrow(x):
+            with transport.connection() as http:
+                self.assertNotIn(http, in_use)
+                in_use.add(http)
+                time.sleep(0.01)
+                in_use.remove(http)
+                return http
+        pool = ThreadPool(6)
+        used = set(pool.map(borrow, range(24)))
+        pool.close()
+        self.assertEqual(len(used), 2)
+        self.assertEqual(transport.created, 2)
+
+    @mock.patch('gdriveapi.httplib2.Http')
+    def test_discovery_document_is_cached(self, Http):
+        document = json.dumps(DRIVE_DISCOVERY)
+        Http.return_value.request.return_value = (
+            httplib2.Response({'status': '200'}), document)
+        cache_path = os.path.join(self.tempdir, 'cache', 'drive.json')
+        self.assertEqual(load_discovery_document(cache_path), document)
+        self.assertEqual(open(cache_path).read(), document)
+        self.assertEqual(Http.return_value.request.call_count, 1)
+        # Later loads never touch the network
+        self.assertEqual(load_discovery_document(cache_path), document)
+        self.assertEqual(Http.return_value.request.call_count, 1)
+
+    @mock.patch('gdriveapi.httplib2.Http')
+    def test_stale_discovery_document_is_refreshed(self, Http):
+        Http.return_value.request.return_value = (
+            httplib2.Response({'status': '200'}), '{"revision": "new"}')
+        cache_path = os.path.join(self.tempdir, 'drive.json')
+        with open(cache_path, 'w') as cache_file:
+            cache_file.write('{"revision": "old"}')
+        os.utime(cache_path, (0, 0))
+        with mock.patch('gdriveapi.threading.Thread') as Thread:
+            document = load_discovery_document(cache_path)
+            # The stale copy is used while the refresh runs
+            self.assertEqual(document, '{"revision": "old"}')
+            refresh = Thread.call_args[1]
+            refresh['target'](*refresh['args'])
+        self.assertEqual(open(cache_path).read(), '{"revision": "new"}')
+
+    @mock.patch('gdriveapi.time.sleep')
+    def test_executor_retries_rate_limited_requests(self, sleep):
+        rate_limited = {'error': {'errors': [
+            {'reason': 'rateLimitExceeded'}]}}
+        gdrive, http = fake_gdrive([
+            ({'status': '403'}, rate_limited),
+            ({'status': '503'}, ''),
+            ({'status': '200'}, {'items': [{'id': '1'}]}),
+        ])
+        gdrive.executor = RequestExecutor(max_concurrency=8)
+        self.assertEqual(gdrive.get_file_info(title="a")[0].id, '1')
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(gdrive.executor.retries, 2)
+        self.assertEqual(int(gdrive.executor.concurrency), 4)
+
+    @mock.patch('gdriveapi.time.sleep')
+    def test_executor_raises_after_retries(self, sleep):
+        gdrive, http = fake_gdrive([({'status': '500'}, '')] * 3 + [
+            ({'status': '404'}, '')])
+        gdrive.executor = RequestExecutor(max_retries=2)
+        with self.assertRaises(HttpError) as context:
+            gdrive.get_file_info(title="a")
+        self.assertEqual(context.exception.resp.status, 500)
+        # Errors which aren't worth retrying are raised straight away
+        with self.assertRaises(HttpError):
+            gdrive.get_file_resource('missing')
+        self.assertEqual(sleep.call_count, 2)
+
+    @mock.patch('gdriveapi.time.sleep')
+    def test_batch_server_errors_do_not_throttle(self, sleep):
+        gdrive, http = fake_gdrive([
+            batch_response([('1', 503, {'error': {'errors': []}})]),
+            batch_response([('1', 200, {'id': '1'})]),
+        ])
+        gdrive.executor = RequestExecutor(max_concurrency=8)
+        files, failures = gdrive.get_many(['1'])
+        self.assertEqual(files['1'].id, '1')
+        self.assertEqual(gdrive.executor.concurrency, 8)
+
+    def test_executor_adjusts_concurrency(self):
+        executor = RequestExecutor(max_concurrency=8)
+        executor.throttled()
+        executor.throttled()
+        self.assertEqual(executor.concurrency, 2)
+        for x in range(4):
+            executor.succeeded()
+        self.assertEqual(int(executor.concurrency), 3)
+        for x in range(10):
+            executor.throttled()
+        self.assertEqual(executor.concurrency, 1)
+
+    def test_gdrive_file_types_are_reused(self):
+        gdrive, http = fake_gdrive([])
+        files = gdrive.create_gdrive_files([
+            {'id': '1', 'title': 'a'},
+            {'title': 'b', 'id': '2'},
+            {'id': '3'},
+        ])
+        self.assertIs(type(files[0]), type(files[1]))
+        self.assertIsNot(type(files[0]), type(files[2]))
+        self.assertEqual(files[1].title, 'b')
+
+    @mock.patch('gdriveapi.time.sleep')
+    def test_get_many_retries_failed_lookups(self, sleep):
+        rate_limited = {'error': {'errors': [
+            {'reason': 'userRateLimitExceeded'}]}}
+        gdrive, http = fake_gdrive([
+            batch_response([
+                ('1', 200, {'id': '1', 'title': 'one'}),
+                ('2', 403, rate_limited),
+                ('3', 404, {'error': {'errors': [{'reason': 'notFound'}]}}),
+            ]),
+            batch_response([('2', 200, {'id': '2', 'title': 'two'})]),
+        ])
+        files, failures = gdrive.get_many(['1', '2', '3'], fields="id,title")
+        self.assertEqual(files['1'].title, 'one')
+        self.assertEqual(files['2'].title, 'two')
+        self.assertEqual(failures.keys(), ['3'])
+        self.assertEqual(failures['3'].resp.status, 404)
+        self.assertEqual(sleep.call_count, 1)
+
+    def test_download_to_streams_chunks(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '200'}, {'id': '1', 'fileSize': '10',
+                'downloadUrl': 'https://example.com/1'}),
+            ({'status': '206', 'content-range': 'bytes 0-3/10'}, '0123'),
+            ({'status': '206', 'content-range': 'bytes 4-7/10'}, '4567'),
+            ({'status': '206', 'content-range': 'bytes 8-9/10'}, '89'),
+        ])
+        progress = []
+        destination = os.path.join(self.tempdir, 'file')
+        size = gdrive.download_to(destination, '1', chunk_size=4,
+            progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(size, 10)
+        self.assertEqual(open(destination).read(), '0123456789')
+        self.assertEqual(progress, [(4, 10), (8, 10), (10, 10)])
+
+    def test_download_to_resumes_partial_file(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '200'}, {'id': '1', 'fileSize': '10',
+                'downloadUrl': 'https://example.com/1'}),
+            ({'status': '206', 'content-range': 'bytes 6-9/10'}, '6789'),
+        ])
+        destination = os.path.join(self.tempdir, 'file')
+        with open(destination, 'wb') as partial:
+            partial.write('012345')
+        gdrive.download_to(destination, '1', chunk_size=4, resume=True)
+        self.assertEqual(open(destination).read(), '0123456789')
+
+    def test_download_to_overwrites_unless_resuming(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '200'}, {'id': '1', 'fileSize': '4',
+                'downloadUrl': 'https://example.com/1'}),
+            ({'status': '206', 'content-range': 'bytes 0-3/4'}, 'abcd'),
+        ])
+        destination = os.path.join(self.tempdir, 'file')
+        with open(destination, 'wb') as old:
+            old.write('an older, longer copy')
+        gdrive.download_to(destination, '1', chunk_size=4)
+        self.assertEqual(open(destination).read(), 'abcd')
+
+    def test_download_to_restarts_changed_partial_file(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '200'}, {'id': '1', 'fileSize': '4', 'etag': '"e"',
+                'md5Checksum': hashlib.md5('abcd').hexdigest(),
+                'downloadUrl': 'https://example.com/1'}),
+            ({'status': '206', 'content-range': 'bytes 2-3/4'}, 'cd'),
+            ({'status': '206', 'content-range': 'bytes 0-3/4'}, 'abcd'),
+        ])
+        destination = os.path.join(self.tempdir, 'file')
+        with open(destination, 'wb') as partial:
+            partial.write('xy')
+        with mock.patch('gdriveapi.request_range', 
+                wraps=gdriveapi.request_range) as request_range:
+            size = gdrive.download_to(destination, '1', chunk_size=4, 
+                resume=True)
+        self.assertEqual(size, 4)
+        self.assertEqual(open(destination).read(), 'abcd')
+        first, second = [call[0][2] for call in request_range.call_args_list]
+        self.assertEqual(first, {'Range': 'bytes=2-5', 'If-Range': '"e"'})
+        self.assertEqual(second, {'Range': 'bytes=0-3'})
+
+    def test_download_to_truncates_oversized_partial_file(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '200'}, {'id': '1', 'fileSize': '4',
+                'downloadUrl': 'https://example.com/1'}),
+            ({'status': '206', 'content-range': 'bytes 0-3/4'}, 'abcd'),
+        ])
+        destination = os.path.join(self.tempdir, 'file')
+        with open(destination, 'wb') as partial:
+            partial.write('too long to be a prefix')
+        gdrive.download_to(destination, '1', chunk_size=4, resume=True)
+        self.assertEqual(open(destination).read(), 'abcd')
+
+    def test_download_many_starts_largest_files_first(self):
+        def text(id, title, size):
+            return {'id': id, 'title': title, 'fileSize': str(size),
+                'downloadUrl': 'https://example.com/' + id}
+        gdrive, http = fake_gdrive([
+            ({'status': '200'}, {'items': [text('a', 'a.txt', 1), 
+                text('b', 'b.txt', 3), text('c', 'a.txt', 2)]}),
+            ({'status': '206', 'content-range': 'bytes 0-2/3'}, 'bbb'),
+            ({'status': '206', 'content-range': 'bytes 0-1/2'}, 'cc'),
+            ({'status': '206', 'content-range': 'bytes 0-0/1'}, 'a'),
+        ])
+        downloaded, failures = gdrive.download_many({'parents_in': 'f'},
+            self.tempdir, workers=1)
+        self.assertEqual(failures, {})
+        for file_id, contents in (('a', 'a'), ('b', 'bbb'), ('c', 'cc')):
+            self.assertEqual(open(downloaded[file_id]).read(), contents)
+        self.assertEqual(sorted(os.listdir(self.tempdir)), 
+            ['a (c).txt', 'a.txt', 'b.txt'])
+
+    def test_download_to_exports_google_docs(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '200'}, {'id': '1', 
+                'mimeType': 'application/vnd.google-apps.spreadsheet',
+                'modifiedDate': '2013-10-01T12:00:00.000Z',
+                'exportLinks': {
+                    'application/pdf': 'https://example.com/1.pdf',
+                    'text/csv': 'https://example.com/1.csv',
+                }}),
+            ({'status': '200'}, 'a,b'),
+        ], export_formats={
+            'application/vnd.google-apps.spreadsheet': ['text/csv']})
+        destination = os.path.join(self.tempdir, 'sheet.csv')
+        with mock.patch.object(http, 'request', 
+                wraps=http.request) as request:
+            gdrive.download_to(destination, '1')
+        self.assertEqual(request.call_args[0][0], 'https://example.com/1.csv')
+        self.assertEqual(open(destination).read(), 'a,b')
+        self.assertEqual(os.path.getmtime(destination), 1380628800)
+
+    def test_byte_budget_limits_bytes_in_use(self):
+        budget = ByteBudget(10)
+        in_use = []
+        def reserve(size):
+            with budget.reserve(size):
+                in_use.append(budget.in_use)
+                time.sleep(0.01)
+        pool = ThreadPool(4)
+        pool.map(reserve, [8, 5, 20, 2, 3])
+        pool.close()
+        pool.join()
+        self.assertEqual(budget.in_use, 0)
+        self.assertTrue(all(used <= 10 or used == 20 for used in in_use),
+            in_use)
+
+    def test_download_file_returns_content(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '200'}, {'id': '1',
+                'downloadUrl': 'https://example.com/1'}),
+            ({'status': '200'}, 'contents'),
+        ])
+        self.assertEqual(gdrive.download_file('1'), 'contents')
+
+    def test_upload_file_in_chunks(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '200', 'location': 'https://example.com/session'},
+                ''),
+            ({'status': '308', 'range': 'bytes=0-262143'}, ''),
+            ({'status': '200'}, {'id': 'uploaded', 'title': 'upload.txt'}),
+        ], upload_state_dir=self.tempdir)
+        filepath = os.path.join(self.tempdir, 'upload.txt')
+        with open(filepath, 'wb') as upload:
+            upload.write('x' * 300000)
+        progress = []
+        uploaded = gdrive.upload_file(filepath, chunk_size=256 * 1024,
+            mimeType='text/plain', parents=['folder'],
+            progress=lambda done, total: progress.append(done))
+        self.assertEqual(uploaded.id, 'uploaded')
+        self.assertEqual(progress, [262144, 300000])
+        self.assertEqual(os.listdir(self.tempdir), ['upload.txt'])
+
+    def test_upload_file_resumes_session(self):
+        gdrive, http = fake_gdrive([
+            # The status query of the persisted session
+            ({'status': '308', 'range': 'bytes=0-262143'}, ''),
+            ({'status': '200'}, {'id': 'uploaded'}),
+        ], upload_state_dir=self.tempdir)
+        filepath = os.path.join(self.tempdir, 'upload.txt')
+        with open(filepath, 'wb') as upload:
+            upload.write('x' * 300000)
+        stat = os.stat(filepath)
+        gdrive.save_upload_session(gdrive.upload_session_path(filepath), {
+            'uri': 'https://example.com/session', 'size': stat.st_size,
+            'mtime': stat.st_mtime})
+        uploaded = gdrive.upload_file(filepath, chunk_size=256 * 1024,
+            mimeType='text/plain')
+        self.assertEqual(uploaded.id, 'uploaded')
+        self.assertEqual(len(http._iterable), 0)
+        self.assertEqual(os.listdir(self.tempdir), ['upload.txt'])
+
+    def test_upload_file_discards_session_of_changed_file(self):
+        gdrive, http = fake_gdrive([
+            # A new session is started rather than resuming the old one
+            ({'status': '200', 'location': 'https://example.com/new'}, ''),
+            ({'status': '200'}, {'id': 'uploaded'}),
+        ], upload_state_dir=self.tempdir)
+        filepath = os.path.join(self.tempdir, 'upload.txt')
+        with open(filepath, 'wb') as upload:
+            upload.write('x' * 1000)
+        gdrive.save_upload_session(gdrive.upload_session_path(filepath), {
+            'uri': 'https://example.com/old', 'size': 300000, 'mtime': 0})
+        uploaded = gdrive.upload_file(filepath, chunk_size=256 * 1024,
+            mimeType='text/plain')
+        self.assertEqual(uploaded.id, 'uploaded')
+        self.assertEqual(len(http._iterable), 0)
+
+    def test_upload_file_restarts_expired_session(self):
+        gdrive, http = fake_gdrive([
+            ({'status': '404'}, ''),
+            ({'status': '200', 'location': 'https://example.com/new'}, ''),
+            ({'status': '200'}, {'id': 'uploaded'}),
+        ], upload_state_dir=self.tempdir)
+        filepath = os.path.join(self.tempdir, 'upload.txt')
+        with open(filepath, 'wb') as upload:
+            upload.write('x' * 1000)
+        stat = os.stat(filepath)
+        gdrive.save_upload_session(gdrive.upload_session_path(filepath), {
+            'uri': 'https://example.com/old', 'size': stat.st_size,
+            'mtime': stat.st_mtime})
+        uploaded = gdrive.upload_file(filepath, mimeType='text/plain')
+        self.assertEqual(uploaded.id, 'uploaded')
+        self.assertEqual(os.listdir(self.tempdir), ['upload.txt'])
+
+    def test_upload_many_reports_failures(self):
+        gdrive, http = fake_gdrive([])
+        def upload_file(filepath, **kwargs):
+            if filepath == 'bad':
+                raise IOError(filepath)
+            return filepath.upper()
+        gdrive.upload_file = upload_file
+        files, failures = gdrive.upload_many(['a', 'bad', 'c'], workers=2)
+        self.assertEqual(files, {'a': 'A', 'c': 'C'})
+        self.assertEqual(failures.keys(), ['bad'])
+
+
+class GDriveBackupTests(unittest.TestCase):
+    """ Tests GDriveBackup against a local fake of Google Drive """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_sync_downloads_only_changes(self):
+        child = {'id': 'a', 'title': 'a.txt', 'mimeType': 'text/plain',
+            'downloadUrl': 'https://example.com/a', 
+            'labels': {'trashed': False}, 'parents': [{'id': 'folder'}]}
+        backup, http = fake_backup([
+            ({'status': '200'}, {'largestChangeId': '10', 
+                'rootFolderId': 'root'}),
+            batch_response([('root', 200, {'items': [BACKUP_FOLDER]})]),
+            ({'status': '200'}, {'items': [child]}),
+            ({'status': '200'}, child),
+            ({'status': '200'}, 'first'),
+            # Second run
+            ({'status': '200'}, {'largestChangeId': '12', 'items': [
+                {'fileId': 'a', 'file': child},
+                {'fileId': 'b', 'file': dict(child, id='b', 
+                    parents=[{'id': 'elsewhere'}])},
+            ]}),
+            ({'status': '200'}, child),
+            ({'status': '200'}, 'second'),
+        ], self.tempdir)
+        path = os.path.join(self.tempdir, 'Backup', 'a.txt')
+        backup.sync()
+        self.assertEqual(open(path).read(), 'first')
+        backup.sync()
+        self.assertEqual(open(path).read(), 'second')
+        self.assertEqual(len(http._iterable), 0)
+        state = backup.db['sync_table'].find_one(name='largestChangeId')
+        self.assertEqual(state['value'], '12')
+
+    def watch_in_background(self, backup, http, client, **kwargs):
+        """ Watches with a local NotificationServer while client posts 
+        notifications to it from another thread, client is given the
+        server and an Event which stops watching """
+        server = gdrive_backup.NotificationServer(('127.0.0.1', 0))
+        stop = threading.Event()
+        thread = threading.Thread(target=client, args=(server, stop))
+        thread.daemon = True
+        # The token is the first id watch generates
+        ids = iter([mock.Mock(hex='token')])
+        uuid4 = gdrive_backup.uuid.uuid4
+        with mock.patch.object(gdrive_backup, 'uuid') as uuid:
+            uuid.uuid4.side_effect = lambda: next(ids, None) or uuid4()
+            thread.start()
+            backup.watch('https://example.com/notify', server, stop=stop, 
+                **kwargs)
+        thread.join()
+
+    def test_watch_syncs_on_notifications(self):
+        child = {'id': 'a', 'title': 'a.txt', 'mimeType': 'text/plain',
+            'downloadUrl': 'https://example.com/a', 
+            'labels': {'trashed': False}, 'parents': [{'id': 'folder'}]}
+        expiration = str(int((time.time() + 3600) * 1000))
+        backup, http = fake_backup([
+            ({'status': '200'}, {'resourceId': 'r1', 
+                'expiration': expiration}),
+            ({'status': '200'}, {'largestChangeId': '10', 
+                'rootFolderId': 'root'}),
+            batch_response([('root', 200, {'items': [BACKUP_FOLDER]})]),
+            ({'status': '200'}, {'items': []}),
+            # Notified of a change
+            ({'status': '200'}, {'largestChangeId': '12', 'items': [
+                {'fileId': 'a', 'file': child}]}),
+            ({'status': '200'}, child),
+            ({'status': '200'}, 'changed'),
+            # Stopped
+            ({'status': '204'}, ''),
+        ], self.tempdir)
+        def client(server, stop):
+            wait_for(lambda: len(http._iterable) == 4)
+            notify(server, 'channel', 'wrong', 'change')
+            notify(server, 'channel', 'token', 'sync')
+            notify(server, 'channel', 'token', 'change')
+            wait_for(lambda: len(http._iterable) == 1)
+            stop.set()
+        self.watch_in_background(backup, http, client)
+        path = os.path.join(self.tempdir, 'Backup', 'a.txt')
+        self.assertEqual(open(path).read(), 'changed')
+        self.assertEqual(len(http._iterable), 0)
+        # The channel was closed
+        self.assertEqual(backup.db['sync_table'].find_one(name='channel'),
+            None)
+
+    def test_watch_renews_channels(self):
+        backup, http = fake_backup([
+            ({'status': '200'}, {'resourceId': 'r1', 
+                'expiration': str(int((time.time() + 2) * 1000))}),
+            ({'status': '200'}, {'largestChangeId': '10', 
+                'rootFolderId': 'root'}),
+            batch_response([('root', 200, {'items': [BACKUP_FOLDER]})]),
+            ({'status': '200'}, {'items': []}),
+            # Renewed
+            ({'status': '200'}, {'resourceId': 'r2', 
+                'expiration': str(int((time.time() + 3600) * 1000))}),
+            ({'status': '204'}, ''),
+            # Stopped
+            ({'status': '204'}, ''),
+        ], self.tempdir)
+        def client(server, stop):
+            wait_for(lambda: len(http._iterable) == 1)
+            stop.set()
+        self.watch_in_background(backup, http, client, renew_seconds=1.5)
+        # Both channels were closed
+        self.assertEqual(len(http._iterable), 0)
+        self.assertEqual(backup.db['sync_table'].find_one(name='channel'),
+            None)
+
+    def test_sync_follows_new_sub_folders(self):
+        folder = {'id': 'new', 'title': 'New', 'labels': {'trashed': False},
+            'mimeType': 'application/vnd.google-apps.folder', 
+            'parents': [{'id': 'folder'}]}
+        child = {'id': 'a', 'title': 'a.txt', 'mimeType': 'text/plain',
+            'downloadUrl': 'https://example.com/a', 
+            'labels': {'trashed': False}, 'parents': [{'id': 'new'}]}
+        backup, http = fake_backup([
+            ({'status': '200'}, {'largestChangeId': '10', 
+                'rootFolderId': 'root'}),
+            batch_response([('root', 200, {'items': [BACKUP_FOLDER]})]),
+            ({'status': '200'}, {'items': []}),
+            # Second run, the new folder is listed when it is created
+            ({'status': '200'}, {'largestChangeId': '12', 'items': [
+                {'fileId': 'new', 'file': folder},
+                {'fileId': 'a', 'file': child},
+            ]}),
+            ({'status': '200'}, {'items': []}),
+            ({'status': '200'}, child),
+            ({'status': '200'}, 'contents'),
+        ], self.tempdir)
+        backup.sync()
+        backup.sync()
+        path = os.path.join(self.tempdir, 'Backup', 'New', 'a.txt')
+        self.assertEqual(open(path).read(), 'contents')
+        self.assertEqual(len(http._iterable), 0)
+        self.assertEqual(
+            backup.db['folder_table'].find_one(folder_id='new')
+                ['filesystem_path'], os.path.dirname(path))
+
+    def test_sync_skips_unchanged_and_duplicate_files(self):
+        def text(id, title, contents, modified):
+            return {'id': id, 'title': title, 'mimeType': 'text/plain',
+                'downloadUrl': 'https://example.com/' + id, 
+                'md5Checksum': hashlib.md5(contents).hexdigest(),
+                'fileSize': str(len(contents)), 'modifiedDate': modified,
+                'labels': {'trashed': False}, 'parents': [{'id': 'folder'}]}
+        a = text('a', 'a.txt', 'same', '2013-10-01T12:00:00.000Z')
+        b = text('b', 'b.txt', 'same', '2013-10-02T12:00:00.000Z')
+        changed = text('a', 'a.txt', 'new', '2013-10-03T12:00:00.000Z')
+        backup, http = fake_backup([
+            ({'status': '200'}, {'largestChangeId': '10', 
+                'rootFolderId': 'root'}),
+            batch_response([('root', 200, {'items': [BACKUP_FOLDER]})]),
+            ({'status': '200'}, {'items': [a, b]}),
+            # b has the same contents as a and isn't downloaded
+            ({'status': '200'}, a),
+            ({'status': '200'}, 'same'),
+            # Second run, b is unchanged
+            ({'status': '200'}, {'largestChangeId': '12', 'items': [
+                {'fileId': 'b', 'file': b},
+                {'fileId': 'a', 'file': changed},
+            ]}),
+            ({'status': '200'}, changed),
+            ({'status': '200'}, 'new'),
+        ], self.tempdir)
+        backup.sync()
+        directory = os.path.join(self.tempdir, 'Backup')
+        self.assertEqual(open(os.path.join(directory, 'b.txt')).read(), 
+            'same')
+        self.assertEqual(os.stat(os.path.join(directory, 'a.txt')).st_ino,
+            os.stat(os.path.join(directory, 'b.txt')).st_ino)
+        backup.sync()
+        self.assertEqual(open(os.path.join(directory, 'a.txt')).read(), 
+            'new')
+        self.assertEqual(open(os.path.join(directory, 'b.txt')).read(), 
+            'same')
+        self.assertEqual(len(http._iterable), 0)
+
+    def test_sync_exports_google_docs_once(self):
+        doc = {'id': 'doc', 'title': 'Notes', 
+            'mimeType': 'application/vnd.google-apps.document',
+            'modifiedDate': '2013-10-01T12:00:00.000Z',
+            'exportLinks': {'application/pdf': 'https://example.com/doc.pdf'},
+            'labels': {'trashed': False}, 'parents': [{'id': 'folder'}]}
+        backup, http = fake_backup([
+            ({'status': '200'}, {'largestChangeId': '10', 
+                'rootFolderId': 'root'}),
+            batch_response([('root', 200, {'items': [BACKUP_FOLDER]})]),
+            ({'status': '200'}, {'items': [doc]}),
+            ({'status': '200'}, doc),
+            ({'status': '200'}, '%PDF'),
+            # Second run, the document is unchanged
+            ({'status': '200'}, {'largestChangeId': '12', 'items': [
+                {'fileId': 'doc', 'file': doc}]}),
+        ], self.tempdir)
+        backup.sync()
+        backup.sync()
+        path = os.path.join(self.tempdir, 'Backup', 'Notes.pdf')
+        self.assertEqual(open(path).read(), '%PDF')
+        self.assertEqual(len(http._iterable), 0)
+
+    def test_backup_keeps_files_inside_backup_path(self):
+        def text(id, title):
+            return {'id': id, 'title': title, 'mimeType': 'text/plain',
+                'downloadUrl': 'https://example.com/' + id}
+        backup, http = fake_backup([
+            ({'status': '200'}, {'largestChangeId': '10', 
+                'rootFolderId': 'root'}),
+            batch_response([('root', 200, {'items': [BACKUP_FOLDER]})]),
+            ({'status': '200'}, {'items': [text('a', '../../escaped'), 
+                text('b', '..'), text('c', 'same'), text('d', 'same')]}),
+            ({'status': '200'}, text('a', '../../escaped')),
+            ({'status': '200'}, 'a'),
+            ({'status': '200'}, text('b', '..')),
+            ({'status': '200'}, 'b'),
+            ({'status': '200'}, text('c', 'same')),
+            ({'status': '200'}, 'c'),
+            ({'status': '200'}, text('d', 'same')),
+            ({'status': '200'}, 'd'),
+        ], self.tempdir)
+        backup.sync()
+        self.assertEqual(sorted(os.listdir(self.tempdir)), 
+            ['Backup', 'config.json'])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.tempdir, 'Backup'))),
+            ['.._.._escaped', '_..', 'same', 'same (d)'])
+
+    def test_path_resolver_lists_each_level_once(self):
+        def folder(id, title, parent):
+            return {'id': id, 'title': title, 'parents': [{'id': parent}]}
+        backup, http = fake_backup([
+            ({'status': '200'}, {'rootFolderId': 'root'}),
+            batch_response([('root', 200, {'items': [folder('a', 'A', 'root'),
+                folder('x', 'X', 'root'), folder('d1', 'D', 'root'),
+                folder('d2', 'D', 'root')]})]),
+            batch_response([('a', 200, {'items': [folder('b', 'B', 'a'),
+                folder('c', "It's", 'a')]})]),
+        ], self.tempdir)
+        paths = ['A/B', "/A/It's/", 'X', 'D', 'A/missing']
+        folder_ids, failures = backup.resolver.resolve(paths)
+        self.assertEqual(folder_ids, {'A/B': 'b', "/A/It's/": 'c', 'X': 'x'})
+        self.assertEqual(sorted(failures), ['A/missing', 'D'])
+        self.assertEqual(len(http._iterable), 0)
+        # Resolved again from the index, renames come from the changes feed
+        backup.resolver.update(backup.api.create_gdrive_files([
+            dict(folder('b', 'Renamed', 'a'), labels={'trashed': False})])[0])
+        folder_ids, failures = backup.resolver.resolve(['A/Renamed', 'A/B'])
+        self.assertEqual(folder_ids, {'A/Renamed': 'b'})
+        self.assertEqual(failures.keys(), ['A/B'])
+        self.assertEqual(backup.construct_query_dict(
+            {'gdrive_path': "It's"})['q'].split(' and ')[0], 
+            "title = 'It\\'s'")
+
+    def test_metadata_index_answers_queries(self):
+        backup, http = fake_backup([], self.tempdir)
+        backup.index.add_files(backup.api.create_gdrive_files([
+            {'id': 'a', 'title': 'Report 2013', 'mimeType': 'text/plain',
+                'modifiedDate': '2013-10-01T12:00:00.000Z', 'fileSize': '5',
+                'parents': [{'id': 'f1'}]},
+            {'id': 'b', 'title': 'Budget', 'mimeType': 'text/plain',
+                'modifiedDate': '2013-11-01T12:00:00.000Z',
+                'parents': [{'id': 'f1'}, {'id': 'f2'}]},
+            {'id': 'c', 'title': 'Report 2012', 'mimeType': 'text/csv',
+                'modifiedDate': '2012-10-01T12:00:00.000Z',
+                'parents': [{'id': 'f2'}]},
+            {'id': 'd', 'title': '100% done_1', 'mimeType': 'text/plain',
+                'modifiedDate': '2012-10-01T12:00:00.000Z',
+                'parents': [{'id': 'f3'}]},
+            {'id': 'e', 'title': '1000 done11', 'mimeType': 'text/plain',
+                'modifiedDate': '2012-10-01T12:00:00.000Z',
+                'parents': [{'id': 'f3'}]},
+        ]))
+        def ids(**kwargs):
+            return sorted(f.id for f in backup.index.query(**kwargs))
+        self.assertEqual(ids(title_contains="Report"), ['a', 'c'])
+        self.assertEqual(ids(parents_in="f2"), ['b', 'c'])
+        self.assertEqual(ids(title_contains="0% done_1"), ['d'])
+        self.assertEqual(ids(title_contains="Report", parents_in="f1"), 
+            ['a'])
+        self.assertEqual(ids(mimeType="text/plain", parents_in="f1"), 
+            ['a', 'b'])
+        self.assertEqual(ids(trashed=False, parents_in="f1"), ['a', 'b'])
+        self.assertEqual(ids(parents_in=["f2", "f3"]), ['b', 'c', 'd', 'e'])
+        self.assertEqual(ids(modifiedDate_gt=datetime(2013, 10, 1, 12)), 
+            ['b'])
+        self.assertEqual(ids(modifiedDate_gte=datetime(2013, 10, 1, 12)), 
+            ['a', 'b'])
+        self.assertEqual(backup.index.query(title="Budget")[0].parents,
+            [{'id': 'f1'}, {'id': 'f2'}])
+        backup.index.remove_file('b')
+        self.assertEqual(ids(parents_in="f2"), ['c'])
+
+    def test_backup_folder_lists_each_folder_once(self):
+        def folder(id):
+            return {'id': id, 'title': id, 
+                'mimeType': 'application/vnd.google-apps.folder'}
+        def text(id):
+            return {'id': id, 'title': id + '.txt', 'mimeType': 'text/plain'}
+        tree = {
+            'root': [folder('f1'), text('a'), folder('f2')],
+            'f1': [text('b'), folder('f2'), folder('f3')],
+            'f2': [text('c')],
+            'f3': [],
+        }
+        backup, http = fake_backup([], self.tempdir)
+        http = FolderTreeHttp(tree)
+        backup.api.credentials.authorize.return_value = http
+        root = os.path.join(self.tempdir, 'root')
+        folders = backup.backup_folder('root', root)
+        self.assertEqual(folders, {
+            'f1': os.path.join(root, 'f1'),
+            'f2': os.path.join(root, 'f2'),
+            'f3': os.path.join(root, 'f1', 'f3'),
+        })
+        self.assertEqual(sorted(http.listed), ['f1', 'f2', 'f3', 'root'])
+        for query in http.queries:
+            self.assertIn('trashed = false', query)
+        self.assertEqual(sorted(f.id for f in backup.index.query()), 
+            ['a', 'b', 'c', 'f1', 'f2', 'f3'])
+        self.assertEqual(backup.jobs.count(), 0)
+
+    def test_get_list_continues_an_interrupted_run(self):
+        def text(id):
+            return {'id': id, 'title': id + '.txt', 'mimeType': 'text/plain',
+                'downloadUrl': 'https://example.com/' + id,
+                'labels': {'trashed': False}, 'parents': [{'id': 'folder'}]}
+        backup, http = fake_backup([
+            ({'status': '200'}, {'rootFolderId': 'root'}),
+            batch_response([('root', 200, {'items': [BACKUP_FOLDER]})]),
+            ({'status': '200'}, {'items': [text('a'), text('b')]}),
+            ({'status': '200'}, text('a')),
+            ({'status': '200'}, 'a'),
+            ({'status': '404'}, {'error': {'message': 'Not Found'}}),
+            # The next run only backs up the file which failed
+            ({'status': '200'}, text('b')),
+            ({'status': '200'}, 'b'),
+        ], self.tempdir)
+        backup.jobs.max_attempts = 1
+        self.assertRaises(IOError, backup.get_list)
+        path_table = backup.db['path_table']
+        self.assertFalse(path_table.find_one(gdrive_path='Backup').get(
+            'crawled'))
+        self.assertEqual(backup.jobs.count(state='failed'), 1)
+        backup.get_list(new_only=True)
+        self.assertEqual(len(http._iterable), 0)
+        for name in ('a', 'b'):
+            path = os.path.join(self.tempdir, 'Backup', name + '.txt')
+            self.assertEqual(open(path).read(), name)
+        self.assertTrue(path_table.find_one(gdrive_path='Backup')['crawled'])
+        self.assertEqual(backup.jobs.count(), 0)
+
+    def test_job_queue_claims(self):
+        db = dataset.connect('sqlite://')
+        jobs = gdrive_backup.JobQueue(db)
+        other = gdrive_backup.JobQueue(db)
+        other.owner = 'otherhost:1'
+        jobs.add('root', [{'kind': 'file', 'item_id': x, 'directory': 'd'}
+            for x in 'abc'])
+        # Already queued
+        jobs.add('root', [{'kind': 'file', 'item_id': 'a', 'directory': 'd'}])
+        self.assertEqual(jobs.count(), 3)
+        self.assertEqual([job['item_id'] for job in jobs.claim('file', 2)],
+            ['a', 'b'])
+        claimed = other.claim('file', 2)
+        self.assertEqual([job['item_id'] for job in claimed], ['c'])
+        self.assertEqual(jobs.claim('file'), [])
+        other.fail(claimed[0], 'error')
+        self.assertEqual(jobs.claim('file')[0]['attempts'], 2)
+        # Jobs of an exited process on this host are claimed again, jobs 
+        # of other hosts are left alone
+        with mock.patch.object(gdrive_backup, 'process_exists', 
+                return_value=False):
+            jobs.requeue_abandoned()
+        self.assertEqual(jobs.count(state='pending'), 3)
+        other.claim('file', 3)
+        with mock.patch.object(gdrive_backup, 'process_exists', 
+                return_value=False):
+            jobs.requeue_abandoned()
+        self.assertEqual(jobs.count(state='running'), 3)
+
+    def test_accounts_have_their_own_credentials_and_database(self):
+        config_path = os.path.join(self.tempdir, 'alice.json')
+        with open(config_path, 'w') as config_file:
+            json.dump({"client_id": "id", "client_secret": "secret",
+                "paths": [], "credentials_file": "alice_credentials",
+                "database": "sqlite:///alice.db",
+                "quota": {"rate": 2.5, "max_concurrency": 3}}, config_file)
+        with mock.patch.object(gdrive_backup, 'Storage') as storage, \
+                mock.patch.object(gdrive_backup.dataset, 'connect',
+                    return_value=dataset.connect('sqlite://')) as connect, \
+                mock.patch.object(gdrive_backup, 'GDriveAPI') as api:
+            gdrive_backup.GDriveBackup(config_path)
+            storage.assert_called_with('alice_credentials')
+            connect.assert_called_with('sqlite:///alice.db')
+            self.assertEqual(api.call_args[0], ('alice_credentials',))
+            executor = api.call_args[1]['executor']
+            self.assertEqual((executor.rate, executor.max_concurrency), 
+                (2.5, 3))
+            # Accounts backed up by backup_accounts must be authenticated
+            storage.return_value.get.return_value = None
+            self.assertRaises(ValueError, gdrive_backup.GDriveBackup, 
+                config_path, interactive=False)
+
+    def test_backup_accounts_summarises_the_run(self):
+        class FakeBackup(object):
+            def __init__(self, config_path, metrics=None, interactive=True):
+                self.config_path = config_path
+                self.metrics = metrics
+            def sync(self):
+                self.metrics.increment('backup_files_total', 
+                    result='downloaded')
+                if self.config_path == 'bad.json':
+                    raise IOError("quota exceeded")
+                self.metrics.increment('backup_files_total', 
+                    result='unchanged')
+        # Worker processes are forked with the fake in place
+        with mock.patch.object(gdrive_backup, 'GDriveBackup', FakeBackup):
+            summary = gdrive_backup.backup_accounts(
+                ['a.json', 'bad.json', 'b.json'], processes=2)
+        self.assertEqual([account['config'] for account in 
+            summary['accounts']], ['a.json', 'bad.json', 'b.json'])
+        self.assertEqual(summary['failed'], 1)
+        self.assertEqual(summary['accounts'][1]['error'], 
+            "IOError: quota exceeded")
+        self.assertEqual(summary['counters'], [
+            {'name': 'backup_files_total', 
+                'labels': {'result': 'downloaded'}, 'value': 3},
+            {'name': 'backup_files_total', 
+                'labels': {'result': 'unchanged'}, 'value': 2},
+        ])
+
 if __name__ == '__main__':
     unittest.main()     